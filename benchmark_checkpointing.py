@@ -0,0 +1,96 @@
+import time
+import json
+import resource
+import argparse
+import multiprocessing as mp
+from easydict import EasyDict as edict
+
+## torch packages
+import torch
+import torch.nn as nn
+
+## custom
+from select_model_input import select_model,get_device
+from export import get_example_inputs
+import config
+
+
+def get_peak_memory(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)/1e6 # MB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3 # MB, ru_maxrss is in KB on linux
+
+
+def run_steps(param,batch_size,seq_len,n_steps,queue):
+    '''
+    A few training steps on a synthetic batch of full length conversations, runs in its own process so that the peak
+    memory of one setting does not hide the one of the next
+    '''
+    param = edict(param)
+    device = get_device(param)
+
+    model = select_model(param)
+    model.train()
+    loss_fn = nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()),lr=param.learning_rate)
+
+    input_ids,arousal,valence,dom,attn_mask = get_example_inputs(model,batch_size,seq_len,param.max_len)
+    text = [input_ids.to(device),arousal.to(device),valence.to(device),dom.to(device)]
+    attn_mask = attn_mask.to(device)
+    target = torch.randint(0,param.output_size,(batch_size,)).to(device)
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+    step_times = []
+    for step in range(n_steps+1):
+        start_time = time.time()
+        optimizer.zero_grad()
+        loss = loss_fn(model(text,attn_mask),target)
+        loss.backward()
+        optimizer.step()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        if step > 0: ## the first step includes allocator and optimizer state warm-up
+            step_times.append(time.time()-start_time)
+
+    queue.put({"step_time":sum(step_times)/len(step_times),"peak_memory_mb":get_peak_memory(device)})
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Peak memory and step time of training with and without gradient checkpointing')
+
+    parser.add_argument('-a', default=config.arch_name,type=str,
+                   help='Enter the architecture, defaults to the one in config.py')
+    parser.add_argument('-b', default="1,2,4",type=str,
+                   help='Enter the comma separated batch sizes')
+    parser.add_argument('-l', default=config.max_len,type=int,
+                   help='Enter the sequence length, defaults to max_len in config.py')
+    parser.add_argument('-n', default=3,type=int,
+                   help='Enter number of timed training steps')
+    parser.add_argument('-o', default=None,type=str,
+                   help='Enter path of a json file for the results')
+
+    args = parser.parse_args()
+
+    ## spawn, so that no child inherits the memory of the parent or of another setting
+    ctx = mp.get_context("spawn")
+    results = []
+    for batch_size in [int(b) for b in args.b.split(",")]:
+        for grad_checkpoint in [False,True]:
+            param = dict(config.param,arch_name=args.a,grad_checkpoint=grad_checkpoint,freeze=False,max_len=args.l)
+            queue = ctx.Queue()
+            process = ctx.Process(target=run_steps,args=(param,batch_size,args.l,args.n,queue))
+            process.start()
+            result = queue.get()
+            process.join()
+
+            result.update({"batch_size":batch_size,"grad_checkpoint":grad_checkpoint})
+            results.append(result)
+            print(f'Batch size {batch_size:3d}, Checkpointing {str(grad_checkpoint):5s}: Peak memory {result["peak_memory_mb"]:.1f} MB, Step time {result["step_time"]:.3f} s')
+
+    if args.o is not None:
+        with open(args.o, 'w') as fp:
+            json.dump(results, fp,indent=4)
+        fp.close()
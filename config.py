@@ -12,8 +12,28 @@ hidden_size = 768 # for bert-based models, cannot change as fine-tuning
 
 embedding_length = None
 
+freeze = False # True trains only the KEA head on cached hidden states of the frozen encoder (see encoder_cache.py)
+
+grad_checkpoint = False # recompute encoder layer and BiLSTM activations in backward, less memory for long conversations
+
+device = None # "cuda", "cpu" or None to use cuda when available
+
+eval_batch_size = 1 # batch size for validation and testing, padding is masked so metrics do not depend on it
+
+max_tokens = None # e.g. 4096, batches examples of similar length up to max_tokens padded tokens instead of batch_size examples
+
+max_len = 512 # tokens per example, e.g. 128 for goemotions/semeval, also the size of the sentence-level lexicon projections
+
+truncation = "head" # "head", "tail" or "head_tail", which tokens of longer examples are kept (see utils.truncate_sequence)
+
+data_format = "pickle" # "columnar" to read the memory-mapped arrays written by preprocess.py -f columnar
+
+accumulation_steps = 1 # batches per optimizer step, the effective batch size is batch_size*accumulation_steps
+
+checkpoint_every = 500 # optimizer steps between saves of last.pth.tar for --resume, None only saves after every epoch
+
 step_size = 10
-start_epoch = 0 # for start training
+start_epoch = 0 # first epoch of the run, --resume continues from the epoch (and batch) stored in last.pth.tar instead
 nepoch = 6
 patience = 30
 
@@ -22,7 +42,7 @@ confusion = False #confusion matrix
 per_class = False # per class accuracy
 
 
-param = {"arch_name":arch_name,"learning_rate":learning_rate,"batch_size":batch_size,"hidden_size":hidden_size,"output_size":output_size,"step_size":step_size,"dataset":dataset,"nepoch":nepoch,"confusion":confusion,"per_class":per_class,"patience":patience}
+param = {"arch_name":arch_name,"learning_rate":learning_rate,"batch_size":batch_size,"hidden_size":hidden_size,"output_size":output_size,"step_size":step_size,"accumulation_steps":accumulation_steps,"checkpoint_every":checkpoint_every,"start_epoch":start_epoch,"dataset":dataset,"nepoch":nepoch,"confusion":confusion,"per_class":per_class,"patience":patience,"freeze":freeze,"grad_checkpoint":grad_checkpoint,"device":device,"eval_batch_size":eval_batch_size,"max_tokens":max_tokens,"max_len":max_len,"truncation":truncation,"data_format":data_format}
 
 tuning = False ## if tuning == True, add the parameter list in train.py
 
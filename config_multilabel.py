@@ -15,7 +15,34 @@ hidden_size = 768 # for -base models
 
 embedding_length = None
 
+freeze = False # True trains only the KEA head on cached hidden states of the frozen encoder (see encoder_cache.py)
+
+grad_checkpoint = False # recompute encoder layer and BiLSTM activations in backward, less memory for long conversations
+
+device = None # "cuda", "cpu" or None to use cuda when available
+
+eval_batch_size = 1 # batch size for validation and testing, padding is masked so metrics do not depend on it
+
+max_tokens = None # e.g. 4096, batches examples of similar length up to max_tokens padded tokens instead of batch_size examples
+
+max_len = 512 # tokens per example, e.g. 128 for goemotions/semeval, also the size of the sentence-level lexicon projections
+
+truncation = "head" # "head", "tail" or "head_tail", which tokens of longer examples are kept (see utils.truncate_sequence)
+
+packing = False # True packs several short examples into each encoder row of max_len tokens, set a larger batch_size
+
+data_format = "pickle" # "columnar" to read the memory-mapped arrays written by preprocess.py -f columnar
+
+accumulation_steps = 1 # batches per optimizer step, the effective batch size is batch_size*accumulation_steps
+
+threshold = 0.3 # sigmoid score threshold of a positive label, taken from the original paper
+
+tune_thresholds = False # per-class thresholds with the best validation F1 every epoch, saved in model_best.pth.tar and used for test
+
+checkpoint_every = 500 # optimizer steps between saves of last.pth.tar for --resume, None only saves after every epoch
+
 step_size = 2
+start_epoch = 0 # first epoch of the run, --resume continues from the epoch (and batch) stored in last.pth.tar instead
 nepoch = 10
 patience = 30
 
@@ -24,6 +51,6 @@ confusion = False #confusion matrix
 per_class = False # per class accuracy
 
 
-param = {"arch_name":arch_name,"learning_rate":learning_rate,"batch_size":batch_size,"hidden_size":hidden_size,"embedding_length":embedding_length,"output_size":output_size,"step_size":step_size,"freeze":False,"dataset":dataset,"nepoch":nepoch,"patience":patience}
+param = {"arch_name":arch_name,"learning_rate":learning_rate,"batch_size":batch_size,"hidden_size":hidden_size,"embedding_length":embedding_length,"output_size":output_size,"step_size":step_size,"accumulation_steps":accumulation_steps,"threshold":threshold,"tune_thresholds":tune_thresholds,"checkpoint_every":checkpoint_every,"start_epoch":start_epoch,"freeze":freeze,"dataset":dataset,"nepoch":nepoch,"patience":patience,"grad_checkpoint":grad_checkpoint,"device":device,"eval_batch_size":eval_batch_size,"max_tokens":max_tokens,"max_len":max_len,"truncation":truncation,"packing":packing,"data_format":data_format}
 
 tuning = False ## if tuning == True, add the parameter list in train.py
@@ -5,11 +5,18 @@ import numpy as np
 import random
 import pandas as pd
 import pickle
+import json
+import itertools
+import functools
 
 ## torch packages
 import torch
 from torch.nn import functional as F
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset,Sampler
+
+## custom
+from utils import truncate_sequence
+from distributed import is_distributed,get_rank,get_world_size
 
 
 class ED_dataset(Dataset):
@@ -30,11 +37,50 @@ class ED_dataset(Dataset):
         item["dom_data"] = torch.Tensor(self.data["dom_data"][index])
         item["emotion"] = self.data["emotion"][index]
 
+        item["index"] = index ## example id, kept through collate for the saved logits
+
         return item
 
     def __len__(self):
         return len(self.data["emotion"])
 
+    def get_lengths(self):
+        return [len(u) for u in self.data["utterance_data"]]
+
+
+class ED_turn_dataset(Dataset):
+
+    '''
+    ED conversations as lists of turns (speaker utterance and listener reply) for the turn-level models, see turn_collate_fn
+    '''
+
+    def __init__(self,data):
+
+        self.data = data
+
+    def __getitem__(self, index):
+
+        item = {}
+
+        item["utterance_data_str"] = self.data["utterance_data_str"][index]
+        item["turn_data"] = [torch.LongTensor(turn) for turn in self.data["turn_data"][index]]
+
+        item["turn_arousal_data"] = [torch.Tensor(vec) for vec in self.data["turn_arousal_data"][index]]
+        item["turn_valence_data"] = [torch.Tensor(vec) for vec in self.data["turn_valence_data"][index]]
+        item["turn_dom_data"] = [torch.Tensor(vec) for vec in self.data["turn_dom_data"][index]]
+        item["emotion"] = self.data["emotion"][index]
+
+        item["index"] = index ## example id, kept through collate for the saved logits
+
+        return item
+
+    def __len__(self):
+        return len(self.data["emotion"])
+
+    def get_lengths(self):
+        ## padded tokens of a conversation in a turn batch, number of turns x longest turn
+        return [len(turns)*max(len(turn) for turn in turns) for turns in self.data["turn_data"]]
+
 
 class GoEmo_dataset(Dataset):
 
@@ -56,11 +102,16 @@ class GoEmo_dataset(Dataset):
         item["dom_data"] = torch.Tensor(self.data["dom_data"][index])
         item["emotion"] = torch.Tensor(self.data["emotion"][index])
 
+        item["index"] = index ## example id, kept through collate for the saved logits
+
         return item
 
     def __len__(self):
         return len(self.data["emotion"])
 
+    def get_lengths(self):
+        return [len(u) for u in self.data["tokenized_cause"]]
+
 class SemEval_dataset(Dataset):
 
     def __init__(self,data):
@@ -81,20 +132,260 @@ class SemEval_dataset(Dataset):
         item["dom_data"] = torch.Tensor(self.data["dom_data"][index])
         item["emotion"] = torch.Tensor(self.data["emotion"][index])
 
+        item["index"] = index ## example id, kept through collate for the saved logits
+
         return item
 
     def __len__(self):
         return len(self.data["emotion"])
 
+    def get_lengths(self):
+        return [len(u) for u in self.data["tokenized_cause"]]
+
+
+class Columnar_dataset(Dataset):
+
+    '''
+    Reads a split written by save_columnar. The arrays are memory-mapped (copy-on-write) on first access, so items are
+    zero-copy views and DataLoader workers share the pages instead of unpickling the whole split
+    '''
+
+    def __init__(self,data_dir):
+
+        self.data_dir = data_dir
+        self.offsets = np.load(os.path.join(data_dir,"offsets.npy"))
+        self.text_offsets = np.load(os.path.join(data_dir,"text_offsets.npy"))
+        self.arrays = None
+
+    def open_arrays(self):
+        self.arrays = {}
+        for key in ["tokens","vad","labels"]:
+            self.arrays[key] = np.load(os.path.join(self.data_dir,key+".npy"),mmap_mode="c")
+        self.arrays["text"] = np.memmap(os.path.join(self.data_dir,"text.bin"),dtype=np.uint8,mode="r")
+
+    def __getstate__(self):
+        ## memmaps are reopened in every worker instead of being pickled with the dataset
+        state = self.__dict__.copy()
+        state["arrays"] = None
+        return state
+
+    def __getitem__(self, index):
+
+        if self.arrays is None:
+            self.open_arrays()
+
+        start,end = self.offsets[index],self.offsets[index+1]
+        text_start,text_end = self.text_offsets[index],self.text_offsets[index+1]
+        labels = self.arrays["labels"]
+
+        item = {}
+
+        item["utterance_data_str"] = json.loads(self.arrays["text"][text_start:text_end].tobytes().decode("utf-8"))
+        item["utterance_data"] = torch.from_numpy(self.arrays["tokens"][start:end])
+
+        item["arousal_data"] = torch.from_numpy(self.arrays["vad"][start:end,0])
+        item["valence_data"] = torch.from_numpy(self.arrays["vad"][start:end,1])
+        item["dom_data"] = torch.from_numpy(self.arrays["vad"][start:end,2])
+
+        if labels.ndim == 1: ## single-label (ed), numerical label as in ED_dataset
+            item["emotion"] = int(labels[index])
+        else: ## multi-label, one-hot encoded
+            item["emotion"] = torch.from_numpy(labels[index])
+
+        item["index"] = index ## example id, kept through collate for the saved logits
+
+        return item
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def get_lengths(self):
+        return np.diff(self.offsets)
+
+
+class Hidden_state_dataset(Columnar_dataset):
+
+    '''
+    Columnar split with the float16 last hidden states of a frozen encoder (hidden.npy, one row per token), written by
+    encoder_cache.build_cache. Items carry them as "hidden_data" in addition to the token ids
+    '''
+
+    def open_arrays(self):
+        super(Hidden_state_dataset, self).open_arrays()
+        self.arrays["hidden"] = np.load(os.path.join(self.data_dir,"hidden.npy"),mmap_mode="c")
+
+    def __getitem__(self, index):
+
+        item = super(Hidden_state_dataset, self).__getitem__(index)
+        item["hidden_data"] = torch.from_numpy(self.arrays["hidden"][self.offsets[index]:self.offsets[index+1]])
+
+        return item
+
+
+def save_columnar(save_dir,tokens,arousal,valence,dom,labels,texts):
+
+    '''
+    Writes one preprocessed split as flat token and vad arrays, an offsets index, a label matrix and the raw texts
+    '''
+    os.makedirs(save_dir,exist_ok=True)
+
+    lengths = [len(t) for t in tokens]
+    offsets = np.zeros(len(tokens)+1,dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    n_tokens = int(offsets[-1])
+
+    flat_tokens = np.fromiter(itertools.chain.from_iterable(tokens),dtype=np.int64,count=n_tokens)
+    vad = np.zeros((n_tokens,3),dtype=np.float32)
+    for j,lexicon_vec in enumerate([arousal,valence,dom]):
+        vad[:,j] = np.fromiter(itertools.chain.from_iterable(lexicon_vec),dtype=np.float32,count=n_tokens)
+
+    labels = np.asarray([l for l in labels])
+    labels = labels.astype(np.int64) if labels.ndim == 1 else labels.astype(np.float32)
+
+    encoded_texts = [json.dumps(t).encode("utf-8") for t in texts]
+    text_offsets = np.zeros(len(texts)+1,dtype=np.int64)
+    text_offsets[1:] = np.cumsum([len(t) for t in encoded_texts])
+
+    np.save(os.path.join(save_dir,"tokens.npy"),flat_tokens)
+    np.save(os.path.join(save_dir,"vad.npy"),vad)
+    np.save(os.path.join(save_dir,"offsets.npy"),offsets)
+    np.save(os.path.join(save_dir,"labels.npy"),labels)
+    np.save(os.path.join(save_dir,"text_offsets.npy"),text_offsets)
+    with open(os.path.join(save_dir,"text.bin"),"wb") as f:
+        f.write(b"".join(encoded_texts))
+
+
+class BucketBatchSampler(Sampler):
+
+    '''
+    Groups examples of similar length into batches of at most max_tokens padded tokens. Examples are shuffled into
+    buckets of bucket_size, sorted by length inside each bucket, and the resulting batches are shuffled again, with a
+    different order every epoch (see set_epoch)
+    '''
+
+    def __init__(self,lengths,max_tokens,max_batch_size=None,bucket_size=1000,shuffle=True,seed=0,max_len=512,num_replicas=1,rank=0):
+
+        self.lengths = np.asarray(lengths)
+        if max_len is not None: ## collate_fn truncates at max_len
+            self.lengths = np.minimum(self.lengths,max_len)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.batches = None
+        ## distributed training, every process takes every num_replicas-th batch of the same shuffled list
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def set_epoch(self,epoch):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.batches = None
+
+    def get_batches(self):
+
+        if self.batches is not None:
+            return self.batches
+
+        rng = np.random.RandomState(self.seed+self.epoch)
+        if self.shuffle:
+            indices = rng.permutation(len(self.lengths))
+        else:
+            indices = np.arange(len(self.lengths))
+
+        batches = []
+        for start in range(0,len(indices),self.bucket_size):
+            bucket = indices[start:start+self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket],kind="stable")]
+
+            batch,batch_max_len = [],0
+            for index in bucket:
+                new_max_len = max(batch_max_len,self.lengths[index])
+                full = new_max_len*(len(batch)+1) > self.max_tokens or (self.max_batch_size is not None and len(batch) == self.max_batch_size)
+                if batch and full:
+                    batches.append(batch)
+                    batch,new_max_len = [],self.lengths[index]
+                batch.append(int(index))
+                batch_max_len = new_max_len
+            if batch:
+                batches.append(batch)
+
+        if self.shuffle:
+            rng.shuffle(batches)
+
+        if self.num_replicas > 1: ## the same number of batches on every process, the first ones are repeated
+            batches = batches+batches[:(-len(batches))%self.num_replicas]
+            batches = batches[self.rank::self.num_replicas]
+
+        self.batches = batches
+        return batches
+
+    def __iter__(self):
+        return iter(self.get_batches())
+
+    def __len__(self):
+        return len(self.get_batches())
+
 
-def collate_fn(data):
+class EpochRandomSampler(Sampler):
+
+    '''
+    Shuffles the examples with a seeded permutation per epoch (see set_epoch), so the order of an epoch can be
+    reproduced when resuming
+    '''
+
+    def __init__(self,data_len,seed=0):
+        self.data_len = data_len
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self,epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        return iter(np.random.RandomState(self.seed+self.epoch).permutation(self.data_len).tolist())
+
+    def __len__(self):
+        return self.data_len
+
+
+class ResumableBatchSampler(Sampler):
+
+    '''
+    Wraps the batch sampler of a training loader. set_start(n) skips the first n batches of the next epoch, only the
+    indices are skipped, not the data loading. len() is always the full epoch
+    '''
+
+    def __init__(self,batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.start = 0
+
+    def set_epoch(self,epoch):
+        for sampler in [self.batch_sampler,getattr(self.batch_sampler,"sampler",None)]:
+            if hasattr(sampler,"set_epoch"):
+                sampler.set_epoch(epoch)
+
+    def set_start(self,start):
+        self.start = start
+
+    def __iter__(self):
+        start,self.start = self.start,0
+        return itertools.islice(iter(self.batch_sampler),start,None)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+def collate_fn(data,max_len=512,truncation="head"):
 
     def merge(sequences,N=None,lexicon=False):
         lengths = [len(seq) for seq in sequences]
         if N == None:
             N = max(lengths)
-            if N  > 512 : # no conversation goes beyond 512.
-                N=512
+            if N  > max_len : # no conversation goes beyond max_len.
+                N=max_len
         if lexicon:
             padded_seqs = torch.zeros(len(sequences),N) ## padding index 0, but float
         else:
@@ -104,10 +395,10 @@ def collate_fn(data):
         for i, seq in enumerate(sequences):
             if not torch.is_tensor(seq):
                 seq = torch.LongTensor(seq)
-            if lengths[i] < 512:
+            if lengths[i] < max_len:
                 end = lengths[i]
             else:
-                end = 512
+                end = max_len
             padded_seqs[i, :end] = seq[:end]
             attention_mask[i,:end] = torch.ones(end).long()
 
@@ -115,6 +406,12 @@ def collate_fn(data):
 
 
 
+    ## tokens, lexicon values and cached hidden states are aligned per token, so they are truncated alike
+    for item in data:
+        for key in ["utterance_data","arousal_data","valence_data","dom_data","hidden_data"]:
+            if key in item:
+                item[key] = truncate_sequence(item[key],max_len,truncation)
+
     data.sort(key=lambda x: len(x["utterance_data"]), reverse=True) ## sort by source seq
 
     item_info = {}
@@ -125,9 +422,10 @@ def collate_fn(data):
     ## input
     input_batch,input_attn_mask, input_lengths = merge(item_info['utterance_data'])
 
-    ainput_batch,_,ainput_lengths = merge(item_info['arousal_data'],N=512,lexicon=True) # not used here, 600 just to make up to xlnet tokenization
-    vinput_batch,_,vinput_lengths = merge(item_info['valence_data'],N=512,lexicon=True) # not used here
-    dinput_batch,_,dinput_lengths = merge(item_info['dom_data'],N=512,lexicon=True) # not used here
+    ## always padded to max_len, the sentence-level models project the whole lexicon vector
+    ainput_batch,_,ainput_lengths = merge(item_info['arousal_data'],N=max_len,lexicon=True)
+    vinput_batch,_,vinput_lengths = merge(item_info['valence_data'],N=max_len,lexicon=True)
+    dinput_batch,_,dinput_lengths = merge(item_info['dom_data'],N=max_len,lexicon=True)
 
 
     d = {}
@@ -139,13 +437,180 @@ def collate_fn(data):
     d["utterance_data"] = input_batch
     d["utterance_data_attn_mask"] = input_attn_mask
 
+    if "hidden_data" in item_info: ## cached hidden states of a frozen encoder, padded like utterance_data
+        hidden_batch = torch.zeros(len(data),input_batch.size()[1],item_info["hidden_data"][0].size()[1],dtype=torch.float16)
+        for i, hidden in enumerate(item_info["hidden_data"]):
+            end = min(len(hidden),input_batch.size()[1])
+            hidden_batch[i,:end] = hidden[:end]
+        d["hidden_data"] = hidden_batch
 
     d["emotion"] = item_info["emotion"]
     d["utterance_data_str"] = item_info['utterance_data_str']
+    if "index" in item_info: ## example ids in the sorted batch order
+        d["index"] = torch.LongTensor(item_info["index"])
+
+    return d
+
+def packed_collate_fn(data,max_len=512,truncation="head"):
+    '''
+    collate_fn, plus the examples packed several per row of at most max_len tokens (first-fit decreasing) with a
+    block-diagonal attention mask and position ids restarting at every example. Lexicon vectors, labels and
+    utterance_data_attn_mask stay one row per example, packed_index holds the flat packed position of every example
+    token (-1 for padding) so the models can unpack the encoder output
+    '''
+    d = collate_fn(data,max_len,truncation) ## sorted by length, longest first
+    lengths = d["utterance_data_attn_mask"].sum(1).tolist()
+
+    row_lengths,placement = [],[]
+    for length in lengths:
+        for row, row_length in enumerate(row_lengths):
+            if row_length+length <= max_len:
+                break
+        else:
+            row = len(row_lengths)
+            row_lengths.append(0)
+        placement.append((row,row_lengths[row]))
+        row_lengths[row] += length
+
+    N = max(row_lengths)
+    packed_batch = torch.zeros(len(row_lengths),N).long() ## padding index 0
+    packed_attn_mask = torch.zeros(len(row_lengths),N,N).long()
+    packed_attn_mask[:,torch.arange(N),torch.arange(N)] = 1 ## padding attends to itself only, never to the examples
+    position_ids = torch.zeros(len(row_lengths),N).long()
+    packed_index = torch.full(d["utterance_data"].size(),-1).long()
+
+    for i, (length, (row, start)) in enumerate(zip(lengths,placement)):
+        end = start+length
+        packed_batch[row,start:end] = d["utterance_data"][i,:length]
+        packed_attn_mask[row,start:end,start:end] = 1
+        position_ids[row,start:end] = torch.arange(length)
+        packed_index[i,:length] = torch.arange(row*N+start,row*N+end)
+
+    d["packed_data"] = packed_batch
+    d["packed_attn_mask"] = packed_attn_mask
+    d["packed_position_ids"] = position_ids
+    d["packed_index"] = packed_index
+
+    return d
+
+def turn_collate_fn(data,max_len=512,truncation="head"):
+    '''
+    Batches the turns of all conversations together, so the turn-level models encode them in one encoder call. Every turn
+    is truncated to max_len, turn_index holds the rows of the turns of each conversation (-1 for padding)
+    '''
+    turns,arousal,valence,dom,turn_index = [],[],[],[],[]
+    for item in data:
+        turn_index.append(list(range(len(turns),len(turns)+len(item["turn_data"]))))
+        turns.extend([truncate_sequence(turn,max_len,truncation) for turn in item["turn_data"]])
+        arousal.extend([truncate_sequence(vec,max_len,truncation) for vec in item["turn_arousal_data"]])
+        valence.extend([truncate_sequence(vec,max_len,truncation) for vec in item["turn_valence_data"]])
+        dom.extend([truncate_sequence(vec,max_len,truncation) for vec in item["turn_dom_data"]])
+
+    N = max([len(turn) for turn in turns])
+    turn_batch = torch.zeros(len(turns),N).long() ## padding index 0
+    turn_attn_mask = torch.zeros(len(turns),N).long()
+    lexicon_batch = torch.zeros(3,len(turns),max_len) ## always padded to max_len, like collate_fn
+    for i, turn in enumerate(turns):
+        turn_batch[i,:len(turn)] = turn
+        turn_attn_mask[i,:len(turn)] = 1
+        lexicon_batch[0,i,:len(turn)] = arousal[i]
+        lexicon_batch[1,i,:len(turn)] = valence[i]
+        lexicon_batch[2,i,:len(turn)] = dom[i]
+
+    index_batch = torch.full((len(data),max([len(index) for index in turn_index])),-1).long()
+    for i, index in enumerate(turn_index):
+        index_batch[i,:len(index)] = torch.LongTensor(index)
+
+    d = {}
+
+    d["turn_data"] = turn_batch
+    d["turn_data_attn_mask"] = turn_attn_mask
+    d["turn_arousal_data"] = lexicon_batch[0]
+    d["turn_valence_data"] = lexicon_batch[1]
+    d["turn_dom_data"] = lexicon_batch[2]
+    d["turn_index"] = index_batch
+
+    d["emotion"] = [item["emotion"] for item in data]
+    d["utterance_data_str"] = [item["utterance_data_str"] for item in data]
+    if "index" in data[0]:
+        d["index"] = torch.LongTensor([item["index"] for item in data])
 
     return d
 
-def get_dataloader(batch_size,dataset,arch_name):
+class ShardSampler(Sampler):
+
+    '''
+    Every num_replicas-th example starting at rank, in order and without padding, so the shards of all processes cover a
+    split exactly once (evaluation in distributed training)
+    '''
+
+    def __init__(self,data_len,num_replicas,rank):
+        self.indices = list(range(rank,data_len,num_replicas))
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def get_train_iter(dataset,batch_size,max_tokens=None,collate=collate_fn,max_len=512):
+
+    if max_tokens is None:
+        if is_distributed(): ## every process trains on its own shard, reshuffled every epoch (see train_model)
+            sampler = torch.utils.data.distributed.DistributedSampler(dataset,num_replicas=get_world_size(),rank=get_rank(),shuffle=True)
+        else:
+            sampler = EpochRandomSampler(len(dataset))
+        batch_sampler = torch.utils.data.BatchSampler(sampler,batch_size,drop_last=False)
+    else:
+        ## length-bucketed batches filled up to max_tokens, batch_size is not used. max_len (None for no limit) is where
+        ## collate truncates the examples
+        batch_sampler = BucketBatchSampler(dataset.get_lengths(),max_tokens,max_len=max_len,num_replicas=get_world_size(),rank=get_rank())
+    ## the order of every epoch is fixed by its number, training can resume in the middle of an epoch (see set_start)
+    return torch.utils.data.DataLoader(dataset, batch_sampler=ResumableBatchSampler(batch_sampler),collate_fn=collate,num_workers=0)
+
+def get_eval_iter(dataset,eval_batch_size,collate=collate_fn):
+
+    ## in distributed training every process evaluates its shard, eval_model gathers the predictions
+    sampler = ShardSampler(len(dataset),get_world_size(),get_rank()) if is_distributed() else None
+    return torch.utils.data.DataLoader(dataset, batch_size=eval_batch_size,shuffle=False,sampler=sampler,collate_fn=collate,num_workers=0)
+
+def get_dataloader(batch_size,dataset,arch_name,data_format="pickle",max_tokens=None,eval_batch_size=1,max_len=512,truncation="head",packing=False):
+
+    ## packing puts several short examples in each row of the encoder input, see packed_collate_fn
+    collate = functools.partial(packed_collate_fn if packing else collate_fn,max_len=max_len,truncation=truncation)
+
+    if arch_name.endswith("_turn"): ## turn-level models, only ed has conversations
+
+        if dataset != "ed" or data_format != "pickle":
+            raise ValueError("turn-level models need the ed dataset in pickle format")
+
+        with open('./.preprocessed_data/mid_dataset_preproc.p', "rb") as f:
+            [data_train, data_valid, data_test, vocab_size, word_embeddings] = pickle.load(f)
+        f.close()
+
+        collate = functools.partial(turn_collate_fn,max_len=max_len,truncation=truncation)
+
+        ## get_lengths already counts padded turn tokens
+        train_iter = get_train_iter(ED_turn_dataset(data_train),batch_size,max_tokens,collate,None)
+
+        # For validation and testing batch_size is eval_batch_size
+        valid_iter  = get_eval_iter(ED_turn_dataset(data_valid),eval_batch_size,collate)
+        test_iter  = get_eval_iter(ED_turn_dataset(data_test),eval_batch_size,collate)
+
+        return train_iter, valid_iter, test_iter
+
+    if data_format == "columnar": ## written by preprocess.py -f columnar, same layout for all datasets
+
+        data_home = "./.preprocessed_data/"+dataset+"_columnar/"
+
+        train_iter  = get_train_iter(Columnar_dataset(data_home+"train"),batch_size,max_tokens,collate,max_len)
+
+        # For validation and testing batch_size is eval_batch_size
+        valid_iter  = get_eval_iter(Columnar_dataset(data_home+"valid"),eval_batch_size,collate)
+        test_iter  = get_eval_iter(Columnar_dataset(data_home+"test"),eval_batch_size,collate)
+
+        return train_iter, valid_iter, test_iter
 
     if dataset == "ed":
 
@@ -155,14 +620,14 @@ def get_dataloader(batch_size,dataset,arch_name):
 
 
         dataset = ED_dataset(data_train)
-        train_iter  = torch.utils.data.DataLoader(dataset, batch_size=batch_size,shuffle=True,collate_fn=collate_fn,num_workers=0)
+        train_iter  = get_train_iter(dataset,batch_size,max_tokens,collate,max_len)
 
-        # For validation and testing batch_size is 1
+        # For validation and testing batch_size is eval_batch_size
         dataset = ED_dataset(data_valid)
-        valid_iter  = torch.utils.data.DataLoader(dataset, batch_size=1,shuffle=False,collate_fn=collate_fn,num_workers=0)
+        valid_iter  = get_eval_iter(dataset,eval_batch_size,collate)
 
         dataset = ED_dataset(data_test)
-        test_iter  = torch.utils.data.DataLoader(dataset, batch_size=1,shuffle=False,collate_fn=collate_fn,num_workers=0)
+        test_iter  = get_eval_iter(dataset,eval_batch_size,collate)
 
         return train_iter, valid_iter, test_iter
 
@@ -175,14 +640,14 @@ def get_dataloader(batch_size,dataset,arch_name):
 
 
         dataset = GoEmo_dataset(data_dict["train"])
-        train_iter  = torch.utils.data.DataLoader(dataset, batch_size=batch_size,shuffle=True,collate_fn=collate_fn,num_workers=0)
+        train_iter  = get_train_iter(dataset,batch_size,max_tokens,collate,max_len)
 
-        # For validation and testing batch_size is 1
+        # For validation and testing batch_size is eval_batch_size
         dataset = GoEmo_dataset(data_dict["valid"])
-        valid_iter  = torch.utils.data.DataLoader(dataset, batch_size=1,shuffle=False,collate_fn=collate_fn,num_workers=0)
+        valid_iter  = get_eval_iter(dataset,eval_batch_size,collate)
 
         dataset = GoEmo_dataset(data_dict["test"])
-        test_iter  = torch.utils.data.DataLoader(dataset, batch_size=1,shuffle=False,collate_fn=collate_fn,num_workers=0)
+        test_iter  = get_eval_iter(dataset,eval_batch_size,collate)
 
 
         return train_iter, valid_iter, test_iter
@@ -195,14 +660,38 @@ def get_dataloader(batch_size,dataset,arch_name):
 
 
         dataset = SemEval_dataset(data_dict["train"])
-        train_iter  = torch.utils.data.DataLoader(dataset, batch_size=batch_size,shuffle=True,collate_fn=collate_fn,num_workers=0)
+        train_iter  = get_train_iter(dataset,batch_size,max_tokens,collate,max_len)
 
-        # For validation and testing batch_size is 1
+        # For validation and testing batch_size is eval_batch_size
         dataset = SemEval_dataset(data_dict["valid"])
-        valid_iter  = torch.utils.data.DataLoader(dataset, batch_size=1,shuffle=False,collate_fn=collate_fn,num_workers=0)
+        valid_iter  = get_eval_iter(dataset,eval_batch_size,collate)
 
         dataset = SemEval_dataset(data_dict["test"])
-        test_iter  = torch.utils.data.DataLoader(dataset, batch_size=1,shuffle=False,collate_fn=collate_fn,num_workers=0)
+        test_iter  = get_eval_iter(dataset,eval_batch_size,collate)
 
 
         return train_iter, valid_iter, test_iter
+
+
+def rebuild_dataloader(data,batch_size,arch_name,max_tokens=None,eval_batch_size=1,max_len=512,truncation="head",packing=False):
+    '''
+    New train/valid/test loaders over the datasets of already loaded ones (from get_dataloader or
+    encoder_cache.get_cached_dataloader), for other batching parameters without reading the data again
+    '''
+    train_data,valid_data,test_data = [data_iter.dataset for data_iter in data]
+
+    if arch_name.endswith("_turn") != isinstance(train_data,ED_turn_dataset):
+        raise ValueError("turn-level and the other models read different datasets, load them with get_dataloader")
+
+    if arch_name.endswith("_turn"):
+        collate = functools.partial(turn_collate_fn,max_len=max_len,truncation=truncation)
+        train_max_len = None ## get_lengths already counts padded turn tokens
+    else:
+        collate = functools.partial(packed_collate_fn if packing else collate_fn,max_len=max_len,truncation=truncation)
+        train_max_len = max_len
+
+    train_iter = get_train_iter(train_data,batch_size,max_tokens,collate,train_max_len)
+    valid_iter = get_eval_iter(valid_data,eval_batch_size,collate)
+    test_iter = get_eval_iter(test_data,eval_batch_size,collate)
+
+    return train_iter, valid_iter, test_iter
@@ -0,0 +1,76 @@
+## Multi-process cpu data-parallel training over the gloo backend, launch with torchrun (see README)
+import os
+
+## torch packages
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def init_distributed(config):
+    '''
+    Joins the process group when started by torchrun (or torch.distributed.launch --use_env), which set RANK,
+    WORLD_SIZE, MASTER_ADDR and MASTER_PORT. Returns False for a normal single-process run
+    '''
+    if int(os.environ.get("WORLD_SIZE",1)) <= 1:
+        return False
+
+    dist.init_process_group("gloo",init_method="env://")
+
+    if config.get("device") is None: ## gloo data parallelism is for cpu hosts
+        config.device = "cpu"
+    ## the processes of one host share its cores
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE",get_world_size()))
+    torch.set_num_threads(max(1,(os.cpu_count() or 1)//local_world_size))
+
+    return True
+
+
+def wrap_model(model):
+    '''
+    DistributedDataParallel averages the gradients over the processes in backward. Every trainable parameter is used
+    in every forward (the encoders are built without the BERT pooler, a frozen encoder has no trainable parameters), so
+    there is no search for unused ones. The only buffers are constant (position ids), so they are not broadcast, which
+    also lets the processes run different numbers of eval batches
+    '''
+    if not is_distributed():
+        return model
+    return DistributedDataParallel(model,broadcast_buffers=False)
+
+def unwrap_model(model):
+    return model.module if isinstance(model,DistributedDataParallel) else model
+
+
+def gather_list(values):
+    '''
+    Concatenates a python list over all processes, rank by rank
+    '''
+    if not is_distributed():
+        return values
+    gathered = [None for _ in range(get_world_size())]
+    dist.all_gather_object(gathered,values)
+    return [value for rank_values in gathered for value in rank_values]
+
+def all_reduce_sum(value):
+    if not is_distributed():
+        return value
+    tensor = torch.tensor([value],dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.item()
@@ -0,0 +1,81 @@
+import os
+import functools
+import numpy as np
+
+## torch packages
+import torch
+
+## custom
+import dataset
+from select_model_input import get_device
+from utils import truncate_sequence
+from distributed import is_main_process,barrier
+
+
+def build_cache(encoder,data,cache_dir,batch_size,device,max_len=512,truncation="head"):
+    '''
+    Runs the encoder once over every example of a split and writes the float16 last hidden states (one row per token,
+    truncated like collate_fn) next to the split in the columnar format
+    '''
+    items = [data[i] for i in range(len(data))]
+    tokens = [truncate_sequence(item["utterance_data"],max_len,truncation).tolist() for item in items]
+    arousal = [truncate_sequence(item["arousal_data"],max_len,truncation).tolist() for item in items]
+    valence = [truncate_sequence(item["valence_data"],max_len,truncation).tolist() for item in items]
+    dom = [truncate_sequence(item["dom_data"],max_len,truncation).tolist() for item in items]
+    labels = [item["emotion"].tolist() if torch.is_tensor(item["emotion"]) else item["emotion"] for item in items]
+    texts = [item["utterance_data_str"] for item in items]
+
+    dataset.save_columnar(cache_dir,tokens,arousal,valence,dom,labels,texts)
+
+    lengths = np.array([len(t) for t in tokens])
+    offsets = np.load(os.path.join(cache_dir,"offsets.npy"))
+    tmp_filename = os.path.join(cache_dir,"hidden.tmp.npy")
+    hidden = np.lib.format.open_memmap(tmp_filename,mode="w+",dtype=np.float16,shape=(int(offsets[-1]),encoder.config.hidden_size))
+
+    ## longest first, so collate_fn keeps the order of every chunk and batches need little padding
+    order = np.argsort(-lengths,kind="stable")
+
+    encoder = encoder.to(device)
+    encoder.eval()
+    with torch.no_grad():
+        for start in range(0,len(order),batch_size):
+            indices = order[start:start+batch_size]
+            batch = dataset.collate_fn([items[i] for i in indices],max_len,truncation)
+
+            output = encoder(batch["utterance_data"].to(device),batch["utterance_data_attn_mask"].to(device),return_dict=True).last_hidden_state
+            output = output.half().cpu().numpy()
+
+            for row, i in enumerate(indices):
+                hidden[offsets[i]:offsets[i+1]] = output[row,:lengths[i]]
+
+    hidden.flush()
+    del hidden
+    os.replace(tmp_filename,os.path.join(cache_dir,"hidden.npy")) ## the cache only counts as built once it is complete
+
+
+def get_cached_dataloader(model,data,config):
+    '''
+    Frozen-encoder training: builds the hidden-state cache of each split once (per dataset and architecture) and returns
+    train/valid/test loaders reading from it, so the encoder never runs during training or evaluation
+    '''
+    if config.arch_name.endswith("_turn"):
+        raise ValueError("frozen-encoder training does not support the turn-level models")
+
+    max_len,truncation = config.get("max_len",512),config.get("truncation","head")
+    cache_home = "./.preprocessed_data/"+config.dataset+"_encoder_cache/"+config.arch_name+"_"+str(max_len)+"_"+truncation+"/"
+    device = get_device(config)
+    collate = functools.partial(dataset.collate_fn,max_len=max_len,truncation=truncation)
+
+    for split, data_iter in zip(["train","valid","test"],data):
+        cache_dir = cache_home+split
+        if is_main_process() and not os.path.exists(os.path.join(cache_dir,"hidden.npy")):
+            print("Caching encoder hidden states for",split)
+            build_cache(model.encoder,data_iter.dataset,cache_dir,max(config.batch_size,config.eval_batch_size),device,max_len,truncation)
+    barrier() ## in distributed training the other processes wait for the cache of the first one
+
+    train_iter = dataset.get_train_iter(dataset.Hidden_state_dataset(cache_home+"train"),config.batch_size,config.max_tokens,collate,max_len)
+
+    valid_iter = dataset.get_eval_iter(dataset.Hidden_state_dataset(cache_home+"valid"),config.eval_batch_size,collate)
+    test_iter = dataset.get_eval_iter(dataset.Hidden_state_dataset(cache_home+"test"),config.eval_batch_size,collate)
+
+    return train_iter, valid_iter, test_iter
@@ -7,7 +7,6 @@ import random
 import numpy as np
 from easydict import EasyDict as edict
 import argparse
-from sklearn.metrics import classification_report,f1_score
 import pickle
 
 ## torch packages
@@ -21,101 +20,68 @@ from torch.utils.tensorboard import SummaryWriter
 import matplotlib.pyplot as plt
 
 ## custom
-from select_model_input import select_model,select_input
+from select_model_input import select_model,select_input,get_device
+from distributed import all_reduce_sum
+from metrics import SingleLabelMetrics
 import dataset
 from label_dict import ed_label_dict,ed_emo_dict,class_names,class_indices
 
 
-def accuracy_topk(output, target, topk=(3,)):
-    """ Taken fromhttps://discuss.pytorch.org/t/imagenet-example-accuracy-calculation/7840/2
-    Computes the precision@k for the specified values of k"""
-    maxk = max(topk)
-    batch_size = target.size(0)
-
-    _, pred = output.topk(maxk, 1, True, True)
-    pred = pred.t()
-    # print(pred,target)
-    correct = pred.eq(target.view(1, -1).expand_as(pred))
-
-    res = []
-    for k in topk:
-        correct_k = correct[:k].view(-1).float().sum(0, keepdim=True)
-        res.append(correct_k.mul_(100.0 / batch_size))
-
-    return res[0].item()
-
 def get_pred_softmax(logits):
     softmax_layer = nn.Softmax(dim=1)
     return softmax_layer(logits)
 
-def eval_model(model, val_iter, loss_fn,log_dict):
+def eval_model(model, val_iter, loss_fn,log_dict,logits_file=None):
+    '''
+    With logits_file, the logits, labels and example ids are saved there (see metrics.save_logits and eval_logits.py)
+    '''
 
     confusion = log_dict.param.confusion
     per_class = log_dict.param.per_class
-    y_true = []
-    y_pred = []
     total_epoch_loss = 0
-    total_epoch_acc = 0
-    total_epoch_acc3 = 0
+    total_examples = 0
 
-    eval_batch_size = 1
-
-    if confusion:
-        conf_matrix = torch.zeros(log_dict.param.output_size, log_dict.param.output_size)
-    if per_class:
-           class_correct = list(0. for i in range(log_dict.param.output_size))
-           class_total = list(0. for i in range(log_dict.param.output_size))
+    ## logits and targets are kept as tensors, every metric is computed once after the loop
+    metrics = SingleLabelMetrics(log_dict.param.output_size,topk=3,labels=class_indices)
 
+    device = get_device(log_dict.param)
+    model = model.to(device)
     model.eval()
     with torch.no_grad():
         for idx, batch in enumerate(val_iter):
-            model = model.cuda()
             text, attn,target = select_input(batch,log_dict.param)
             target = torch.autograd.Variable(target).long()
 
-            if torch.cuda.is_available():
-                text = [text[0].cuda(),text[1].cuda(),text[2].cuda(),text[3].cuda()]
-
-                attn = attn.cuda()
-                target = target.cuda()
+            text = [t.to(device) for t in text]
+            attn = attn.to(device)
+            target = target.to(device)
 
             prediction = model(text,attn)
-
-            correct = np.squeeze(torch.max(prediction, 1)[1].eq(target.view_as(torch.max(prediction, 1)[1])))
-            pred_ind = torch.max(prediction, 1)[1].view(target.size()).data
-
-            if confusion:
-                for t, p in zip(target.data, pred_ind):
-                        conf_matrix[t.long(), p.long()] += 1
-            if per_class:
-                label = target[0]
-                class_correct[label] += correct.item()
-                class_total[label] += 1
+            metrics.update(prediction,target,batch.get("index"))
 
             loss = loss_fn(prediction, target)
 
-            num_corrects = (pred_ind == target.data).sum()
-            y_true.extend(target.data.cpu().tolist())
-            y_pred.extend(pred_ind.cpu().tolist())
+            ## the loss is summed per example, so the average does not depend on the batch size
+            batch_examples = target.size()[0]
+            total_epoch_loss += loss.item()*batch_examples
+            total_examples += batch_examples
 
-            acc = 100.0 * num_corrects/eval_batch_size
-            acc3 = accuracy_topk(prediction, target, topk=(3,))
-            total_epoch_loss += loss.item()
-            total_epoch_acc += acc.item()
-            total_epoch_acc3 += acc3
+    ## gathered over the processes in distributed training
+    results = metrics.compute()
+    if logits_file is not None:
+        metrics.save(logits_file,{"dataset":log_dict.param.dataset,"arch_name":log_dict.param.arch_name,"output_size":log_dict.param.output_size})
+    total_epoch_loss,total_examples = all_reduce_sum(total_epoch_loss),all_reduce_sum(total_examples)
 
-        if confusion:
-            import seaborn as sns
-            sns.heatmap(conf_matrix, annot=True,xticklabels=list(ed_label_dict.keys()),yticklabels=list(ed_label_dict.keys()),cmap='Blues')
-
-            plt.show()
-        if per_class:
-            for i in range(log_dict.param.output_size):
-                print('Test Accuracy of %5s: %2d%% (%2d/%2d)' % (
-                ed_emo_dict[i], 100 * class_correct[i] / class_total[i],
-                np.sum(class_correct[i]), np.sum(class_total[i])))
+    if confusion:
+        import seaborn as sns
+        sns.heatmap(results["confusion_matrix"], annot=True,xticklabels=list(ed_label_dict.keys()),yticklabels=list(ed_label_dict.keys()),cmap='Blues')
 
-    f1_score_e = f1_score(y_true, y_pred, labels=class_indices,average='macro')
-    f1_score_w = f1_score(y_true, y_pred, labels=class_indices,average='weighted')
-    return total_epoch_loss/len(val_iter), total_epoch_acc/len(val_iter),f1_score_e,f1_score_w,total_epoch_acc3/len(val_iter)
+        plt.show()
+    if per_class:
+        class_correct,class_total = results["class_correct"].tolist(),results["class_total"].tolist()
+        for i in range(log_dict.param.output_size):
+            print('Test Accuracy of %5s: %2d%% (%2d/%2d)' % (
+            ed_emo_dict[i], 100 * class_correct[i] / max(1,class_total[i]),
+            class_correct[i], class_total[i]))
 
+    return total_epoch_loss/total_examples, results["accuracy"],results["macro_f1"],results["weighted_f1"],results["topk_accuracy"]
@@ -0,0 +1,112 @@
+## Recomputes evaluation metrics from the logits saved by eval_model (<save_home>/logits/<split>_epochNN.npz), no model is run
+import os
+import json
+import argparse
+import numpy as np
+
+## torch packages
+import torch
+import torch.nn.functional as F
+
+## custom
+from metrics import load_logits,SingleLabelMetrics,MultiLabelMetrics,optimize_thresholds
+from label_dict import ed_emo_dict,goemotions_emo_dict,semeval_emo_dict,class_indices
+
+
+def get_emo_dict(dataset):
+    return {"ed":ed_emo_dict,"goemotions":goemotions_emo_dict,"semeval":semeval_emo_dict}.get(dataset,{})
+
+
+def evaluate_logits(logits,labels,meta,thresholds=None):
+    '''
+    The metrics of eval.py (single-label) or eval_multilabel.py (multilabel, with thresholds or else the ones saved
+    with the logits) of one saved split, plus per-class results
+    '''
+    emo_dict = get_emo_dict(meta["dataset"])
+    n_classes = meta["output_size"]
+    logits,labels = torch.from_numpy(logits),torch.from_numpy(labels)
+
+    if labels.dim() == 1:
+        metrics = SingleLabelMetrics(n_classes,topk=3,labels=class_indices if meta["dataset"] == "ed" else None)
+        metrics.update(logits,labels)
+        scores = metrics.compute()
+        results = {"loss":F.cross_entropy(logits,labels.long()).item(),"accuracy":scores["accuracy"],"top3_accuracy":scores["topk_accuracy"],
+                   "macro_f1":scores["macro_f1"],"weighted_f1":scores["weighted_f1"],"confusion_matrix":scores["confusion_matrix"].tolist()}
+        for i in range(n_classes):
+            total = scores["class_total"][i].item()
+            results[emo_dict.get(i,str(i))+"_accuracy"] = 100.0*scores["class_correct"][i].item()/total if total > 0 else None
+        return results
+
+    if thresholds is None:
+        thresholds = meta.get("thresholds",0.3)
+    metrics = MultiLabelMetrics(n_classes)
+    metrics.update(logits,labels)
+    scores = metrics.compute(thresholds)
+    results = {"loss":F.binary_cross_entropy_with_logits(logits,labels.float()).item(),
+               "precision":scores["precision"],"recall":scores["recall"],"f1":scores["f1"],"thresholds":scores["thresholds"]}
+    for i in range(n_classes):
+        emotion = emo_dict.get(i,str(i))
+        for key in ["accuracy","precision","recall","f1"]:
+            results[emotion+"_"+key] = float(scores["class_"+key][i])
+    return results
+
+
+def get_logits_files(run_home,epoch,splits):
+    '''
+    The saved logits of the splits of one epoch of a run, by default the epoch of model_best.pth.tar (from log.json)
+    '''
+    if epoch is None:
+        with open(os.path.join(run_home,"log.json")) as fp:
+            epoch = json.load(fp)["epoch"]
+    return {split:os.path.join(run_home,"logits",f"{split}_epoch{epoch:02}.npz") for split in splits}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Recompute metrics from saved logits without running the model')
+
+    parser.add_argument('-c', default=None,type=str,
+                   help='Enter the run directory (the one of model_best.pth.tar)')
+    parser.add_argument('-e', default=None,type=int,
+                   help='Enter the epoch, defaults to the best one in log.json')
+    parser.add_argument('-s', default="valid,test",type=str,
+                   help='Enter the comma separated splits')
+    parser.add_argument('-f', default=None,type=str,
+                   help='Enter comma separated logits files instead of -c/-e/-s')
+    parser.add_argument('-t', default=None,type=float,
+                   help='Enter one threshold for all classes (multilabel), defaults to the thresholds saved with the logits')
+    parser.add_argument('--tune', action='store_true',
+                   help='Tune per-class thresholds on the valid split and apply them to every split (multilabel)')
+    parser.add_argument('-o', default=None,type=str,
+                   help='Enter path of a json file for the results')
+
+    args = parser.parse_args()
+
+    if args.f is not None:
+        files = {os.path.splitext(os.path.basename(f))[0]:f for f in args.f.split(",")}
+    else:
+        files = get_logits_files(args.c,args.e,args.s.split(","))
+
+    data = {name:load_logits(filename) for name,filename in files.items()}
+
+    thresholds = args.t
+    if args.tune:
+        valid = [name for name in data if name.startswith("valid")]
+        if not valid:
+            raise SystemExit("--tune needs the logits of the valid split")
+        logits,labels,_,_ = data[valid[0]]
+        thresholds = optimize_thresholds(torch.sigmoid(torch.from_numpy(logits)).numpy(),labels,0.3 if args.t is None else args.t).tolist()
+
+    report = {}
+    for name,(logits,labels,ids,meta) in data.items():
+        report[name] = evaluate_logits(logits,labels,meta,thresholds)
+        result = report[name]
+        if labels.ndim == 1:
+            print(f'{name}: {len(ids)} examples, Loss: {result["loss"]:.3f}, Acc: {result["accuracy"]:.2f}%, Top-3 Acc: {result["top3_accuracy"]:.2f}%, F1: {result["macro_f1"]:.4f}, Weighted F1: {result["weighted_f1"]:.4f}')
+        else:
+            print(f'{name}: {len(ids)} examples, Loss: {result["loss"]:.3f}, Precision: {result["precision"]:.4f}, Recall: {result["recall"]:.4f}, F1: {result["f1"]:.4f}')
+
+    if args.o is not None:
+        with open(args.o, 'w') as fp:
+            json.dump(report, fp,indent=4)
+        fp.close()
@@ -7,7 +7,6 @@ import random
 import numpy as np
 from easydict import EasyDict as edict
 import argparse
-from sklearn.metrics import classification_report,f1_score,precision_recall_fscore_support,average_precision_score,accuracy_score
 import pickle
 
 ## torch packages
@@ -21,78 +20,78 @@ from torch.utils.tensorboard import SummaryWriter
 import matplotlib.pyplot as plt
 
 ## custom
-from select_model_input import select_model,select_input
+from select_model_input import select_model,select_input,get_device
+from distributed import all_reduce_sum,is_main_process
+from metrics import MultiLabelMetrics
 import dataset
 from label_dict import ed_label_dict,ed_emo_dict,class_names,class_indices,goemotions_label_dict,goemotions_emo_dict,semeval_emo_dict,semeval_label_dict
 
 
-def eval_model(model, val_iter, loss_fn,log_dict,save_home):
-
-    y_true = []
-    y_score = []
-    y_pred = []
+def eval_model(model, val_iter, loss_fn,log_dict,save_home,thresholds=None,tune_thresholds=False,logits_file=None):
+    '''
+    thresholds is one per class (e.g. tuned on the validation split) or None for the threshold of the config. With
+    tune_thresholds the per-class thresholds with the best F1 on this split are returned in the results, with the
+    tuned_precision/recall/f1 they reach, the other metrics stay at thresholds. With logits_file, the logits, labels
+    and example ids are saved there with the returned thresholds (see eval_logits.py)
+    '''
     total_epoch_loss = 0
-    total_epoch_acc = 0
-    total_epoch_acc3 = 0
 
-    sigmoid_layer = nn.Sigmoid()
-    threshold = 0.3 ## taken from the original paper
-    eval_batch_size = 1
+    if thresholds is None:
+        thresholds = log_dict.param.get("threshold",0.3) ## 0.3 taken from the original paper
+    ## logits and targets are kept as tensors, every metric is computed once after the loop
+    metrics = MultiLabelMetrics(log_dict.param.output_size)
 
+    device = get_device(log_dict.param)
+    model = model.to(device)
     model.eval()
     with torch.no_grad():
         for idx, batch in enumerate(val_iter):
 
             text, attn, target = select_input(batch,log_dict.param)
 
-            if torch.cuda.is_available():
-                text = [text[0].cuda(),text[1].cuda(),text[2].cuda(),text[3].cuda()]
-
-                model = model.cuda()
-                attn = attn.cuda()
-                target = target.cuda()
+            text = [t.to(device) for t in text]
+            attn = attn.to(device)
+            target = target.to(device)
 
 
             prediction = model(text,attn)
+            metrics.update(prediction,target,batch.get("index"))
 
             loss = loss_fn(prediction, target)
 
-            pred_ind = sigmoid_layer(prediction).detach().cpu().tolist()[0]
+            total_epoch_loss += loss.item()*target.size(0) ## summed per example, the average does not depend on the batch size
 
-            y_score.append(pred_ind)
-            y_pred.append([0 if p <threshold else 1 for p in pred_ind])
-            y_true.append(target.detach().cpu().tolist()[0])
-            total_epoch_loss += loss.item()
+        ## distributed training, every process evaluated its own shard
+        scores = metrics.compute(thresholds)
+        ## tuned on this split, so their F1 is optimistic and only reported, the model is selected on the fixed one
+        tuned = metrics.compute(thresholds,tune=True) if tune_thresholds else scores
+        total_epoch_loss = all_reduce_sum(total_epoch_loss)
+        if logits_file is not None:
+            metrics.save(logits_file,{"dataset":log_dict.param.dataset,"arch_name":log_dict.param.arch_name,"output_size":log_dict.param.output_size,"thresholds":tuned["thresholds"]})
 
-        os.makedirs(save_home,exist_ok=True)
+        if is_main_process():
+            os.makedirs(save_home,exist_ok=True)
         results = {}
-        p,r,f1,_ = precision_recall_fscore_support(y_true, y_pred, average="macro")
-
-        results["precision"] = p
-        results["recall"] = r
-        results["f1"] = f1
-
-        y_true = np.array([np.array(i) for i in y_true])
-        y_pred = np.array([np.array(i) for i in y_pred])
+        results["precision"] = scores["precision"]
+        results["recall"] = scores["recall"]
+        results["f1"] = scores["f1"]
+        results["thresholds"] = tuned["thresholds"]
+        if tune_thresholds:
+            results["tuned_precision"] = tuned["precision"]
+            results["tuned_recall"] = tuned["recall"]
+            results["tuned_f1"] = tuned["f1"]
 
-        # print(y_true[:5,:],y_pred[:5,:])
         if log_dict.param.dataset == "goemotions":
-            for i in range(27):
-                emotion = goemotions_emo_dict[i]
-                emotion_true = y_true[:, i]
-                emotion_pred = y_pred[:, i]
-                # print(emotion_true,emotion_pred)
-                results[emotion + "_accuracy"] = accuracy_score(emotion_true, emotion_pred)
-                results[emotion + "_precision"], results[emotion + "_recall"], results[emotion + "_f1"], _ = precision_recall_fscore_support(
-                        emotion_true, emotion_pred, average="binary")
+            emo_dict = goemotions_emo_dict
         elif log_dict.param.dataset == "semeval":
-            for i in range(11):
-                emotion = semeval_emo_dict[i]
-                emotion_true = y_true[:, i]
-                emotion_pred = y_pred[:, i]
-                # print(emotion_true,emotion_pred)
-                results[emotion + "_accuracy"] = accuracy_score(emotion_true, emotion_pred)
-                results[emotion + "_precision"], results[emotion + "_recall"], results[emotion + "_f1"], _ = precision_recall_fscore_support(
-                        emotion_true, emotion_pred, average="binary")
-
-    return total_epoch_loss/len(val_iter),results
+            emo_dict = semeval_emo_dict
+        else:
+            emo_dict = {}
+        for i in range(log_dict.param.output_size if emo_dict else 0):
+            emotion = emo_dict[i]
+            results[emotion + "_accuracy"] = float(scores["class_accuracy"][i])
+            results[emotion + "_precision"] = float(scores["class_precision"][i])
+            results[emotion + "_recall"] = float(scores["class_recall"][i])
+            results[emotion + "_f1"] = float(scores["class_f1"][i])
+
+    return total_epoch_loss/scores["examples"],results
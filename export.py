@@ -0,0 +1,120 @@
+import os
+import json
+import inspect
+import argparse
+
+## torch packages
+import torch
+import torch.nn as nn
+
+## custom
+from select_model_input import load_model
+from inference_runner import ExportedModel
+
+
+class ExportWrapper(nn.Module):
+
+    '''
+    Flat-argument forward for tracing, (input_ids, arousal, valence, dom, attn_mask) --> logits, the same inputs as
+    model(text,attn_mask) with text = [input_ids, arousal, valence, dom]
+    '''
+
+    def __init__(self,model):
+        super(ExportWrapper, self).__init__()
+        self.model = model
+
+    def forward(self,input_ids,arousal,valence,dom,attn_mask):
+        return self.model([input_ids,arousal,valence,dom],attn_mask)
+
+
+def get_example_inputs(model,batch_size,seq_len,lexicon_len=512):
+
+    vocab_size = model.encoder.config.vocab_size
+
+    input_ids = torch.randint(1000,vocab_size,(batch_size,seq_len)) if vocab_size > 1000 else torch.randint(1,vocab_size,(batch_size,seq_len))
+    input_ids[:,0] = 101
+    attn_mask = torch.ones(batch_size,seq_len).long()
+
+    ## every row after the first is shorter, so tracing goes through padding and packing
+    lengths = torch.linspace(seq_len,max(2,seq_len//2),batch_size).long()
+    lexicon = torch.zeros(3,batch_size,lexicon_len)
+    for i,length in enumerate(lengths):
+        input_ids[i,length:] = 0
+        attn_mask[i,length:] = 0
+        lexicon[:,i,:length] = torch.rand(3,int(length))
+
+    return input_ids,lexicon[0],lexicon[1],lexicon[2],attn_mask
+
+
+def export_model(model,export_format,filename,lexicon_len=512):
+    '''
+    Writes the model as a traced TorchScript module or an ONNX graph with dynamic batch and sequence axes
+    '''
+    wrapper = ExportWrapper(model.to("cpu")).eval()
+    example_inputs = get_example_inputs(model,2,16,lexicon_len)
+
+    with torch.no_grad():
+        if export_format == "torchscript":
+            traced = torch.jit.trace(wrapper,example_inputs,check_trace=False)
+            torch.jit.save(traced,filename)
+        elif export_format == "onnx":
+            ## the TorchScript-based exporter, the dynamo one (default in newer torch) cannot export the packed BiLSTM
+            export_kwargs = {"dynamo":False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+            dynamic_axes = {"input_ids":{0:"batch",1:"sequence"},"arousal":{0:"batch"},"valence":{0:"batch"},"dom":{0:"batch"},"attn_mask":{0:"batch",1:"sequence"},"logits":{0:"batch"}}
+            torch.onnx.export(wrapper,example_inputs,filename,input_names=["input_ids","arousal","valence","dom","attn_mask"],output_names=["logits"],dynamic_axes=dynamic_axes,opset_version=14,**export_kwargs)
+
+
+def check_parity(model,filename,lexicon_len=512,atol=1e-4):
+    '''
+    Compares the logits of the exported artifact with the eager model for batch and sequence sizes other than the traced ones
+    '''
+    exported_model = ExportedModel(filename)
+    model = model.to("cpu").eval()
+
+    max_diff = 0
+    for batch_size,seq_len in [(1,8),(3,40),(5,128)]:
+        seq_len = min(seq_len,lexicon_len) ## collate_fn never builds longer inputs
+        input_ids,arousal,valence,dom,attn_mask = get_example_inputs(model,batch_size,seq_len,lexicon_len)
+        with torch.no_grad():
+            eager_logits = model([input_ids,arousal,valence,dom],attn_mask)
+        exported_logits = exported_model([input_ids,arousal,valence,dom],attn_mask)
+        max_diff = max(max_diff,(eager_logits-exported_logits).abs().max().item())
+
+    return max_diff <= atol,max_diff
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Export a trained model to TorchScript or ONNX')
+
+    parser.add_argument('-c', type=str, required=True,
+                   help='Enter the path of model_best.pth.tar')
+    parser.add_argument('-f', default="torchscript",type=str,
+                   help='Enter export format, torchscript or onnx')
+    parser.add_argument('-o', default=None,type=str,
+                   help='Enter output path, defaults to model.pt/model.onnx next to the checkpoint')
+    parser.add_argument('--check', action='store_true',
+                   help='Compare exported logits with the eager model after exporting')
+
+    args = parser.parse_args()
+
+    filename = args.o or os.path.join(os.path.dirname(args.c),"model.onnx" if args.f == "onnx" else "model.pt")
+
+    model,config = load_model(args.c,device="cpu")
+    model.eval()
+    if config.arch_name.endswith("_turn"): ## the exported graphs take one row per example
+        raise SystemExit("Exporting turn-level models is not supported")
+
+    lexicon_len = config.get("max_len",512) # collate_fn pads the lexicon vectors to max_len
+    export_model(model,args.f,filename,lexicon_len)
+    ## the runner needs the param dict (dataset, output_size, ...) but not the checkpoint
+    with open(os.path.splitext(filename)[0]+".json", 'w') as fp:
+        json.dump(dict(config), fp,indent=4)
+    fp.close()
+    print("Exported to",filename)
+
+    if args.check:
+        passed,max_diff = check_parity(model,filename,lexicon_len)
+        print(f'Parity check {"passed" if passed else "FAILED"}, max abs logit difference: {max_diff:.2e}')
+        if not passed:
+            raise SystemExit(1)
@@ -1,36 +1,97 @@
+import os
+import hashlib
+import itertools
+import numpy as np
 import pandas as pd
 from transformers import BertTokenizer,AutoTokenizer
 
 ##custom packages
 from label_dict import arousal_dict,valence_dict,dom_dict
 
-def get_arousal_vec(tokenizer,utterance):
+vad_tables = {} ## vad tables already loaded in this process, keyed by tokenizer
+
+def get_lexicon_fingerprint():
+
+    lexicon_str = repr([sorted(arousal_dict.items()),sorted(valence_dict.items()),sorted(dom_dict.items())])
+
+    return hashlib.md5(lexicon_str.encode("utf-8")).hexdigest()[:10]
+
+
+def build_vad_table(tokenizer):
+    '''
+    Builds a vocab_size x 3 table with the (arousal,valence,dominance) scores of every token id, 0.5 for tokens missing from the lexicon
+    '''
+    token_str = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer)))) #converts every numerical token to the corresponding string
+
+    vad_table = np.full((len(token_str),3),0.5,dtype=np.float32)
+    for j,lexicon_dict in enumerate([arousal_dict,valence_dict,dom_dict]):
+        for i,token in enumerate(token_str):
+            v = lexicon_dict.get(token)
+            if v is not None:
+                vad_table[i,j] = float(v)
+
+    return vad_table
+
+
+def get_vad_table(tokenizer,cache_dir="./.preprocessed_data/"):
+    '''
+    Returns the vad table of the tokenizer, built once per tokenizer and lexicon pair and saved in cache_dir
+    '''
+    tokenizer_name = getattr(tokenizer,"name_or_path","") or type(tokenizer).__name__
+    table_key = (tokenizer_name,len(tokenizer))
 
-	token_str = tokenizer.convert_ids_to_tokens(utterance) #converts numerical tokens to corresponding strings
+    if table_key not in vad_tables:
+        table_name = "vad_table_"+tokenizer_name.strip("/").replace("/","_")+"_"+str(len(tokenizer))+"_"+get_lexicon_fingerprint()
+        filename = os.path.join(cache_dir,table_name+".npy")
+        if os.path.exists(filename):
+            vad_table = np.load(filename)
+        else:
+            vad_table = build_vad_table(tokenizer)
+            os.makedirs(cache_dir,exist_ok=True)
+            ## written to a temporary file first as several preprocessing workers may build the same table
+            tmp_filename = filename+"."+str(os.getpid())+".tmp"
+            with open(tmp_filename,"wb") as f:
+                np.save(f,vad_table)
+            os.replace(tmp_filename,filename)
+        vad_tables[table_key] = vad_table
 
-	arousal_vec = [arousal_dict.get(i) for i in token_str]
-	arousal_vec = [float(0.5) if v is None else float(v) for v in arousal_vec]
+    return vad_tables[table_key]
 
-	return arousal_vec
 
+def get_vad_batch(tokenizer,utterances):
+    '''
+    Returns the arousal, valence and dominance vectors of a batch of tokenized utterances with a single gather from the vad table
+    '''
+    vad_table = get_vad_table(tokenizer)
+
+    lengths = [len(u) for u in utterances]
+    token_ids = np.fromiter(itertools.chain.from_iterable(utterances),dtype=np.int64,count=sum(lengths))
+    vad = vad_table[token_ids]
+    splits = np.cumsum(lengths)[:-1]
+
+    arousal_vec = [v.tolist() for v in np.split(vad[:,0],splits)]
+    valence_vec = [v.tolist() for v in np.split(vad[:,1],splits)]
+    dom_vec = [v.tolist() for v in np.split(vad[:,2],splits)]
+
+    return arousal_vec,valence_vec,dom_vec
+
+
+def get_arousal_vec(tokenizer,utterance):
+
+    arousal_vec = get_vad_table(tokenizer)[np.asarray(utterance,dtype=np.int64),0].tolist()
+
+    return arousal_vec
 
 
 def get_valence_vec(tokenizer,utterance):
-	output_vec = []
-	token_str = tokenizer.convert_ids_to_tokens(utterance) #converts numerical tokens to corresponding strings
 
-	valence_vec = [valence_dict.get(i) for i in token_str]
-	valence_vec = [float(0.5) if v is None else float(v) for v in valence_vec]
+    valence_vec = get_vad_table(tokenizer)[np.asarray(utterance,dtype=np.int64),1].tolist()
 
-	return valence_vec
+    return valence_vec
 
 
 def get_dom_vec(tokenizer,utterance):
-    output_vec = []
-    token_str = tokenizer.convert_ids_to_tokens(utterance) #converts numerical tokens to corresponding strings
 
-    dom_vec = [dom_dict.get(i) for i in token_str]
-    dom_vec = [float(0.5) if v is None else float(v) for v in dom_vec]
+    dom_vec = get_vad_table(tokenizer)[np.asarray(utterance,dtype=np.int64),2].tolist()
 
     return dom_vec
-
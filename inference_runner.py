@@ -0,0 +1,44 @@
+## Standalone runner for models written by export.py, deliberately does not import transformers or the model code
+import os
+import json
+
+## torch packages
+import torch
+
+
+class ExportedModel:
+
+    '''
+    Loads a TorchScript (.pt) or ONNX (.onnx) artifact written by export.py and runs it with the same inputs as the
+    eager models, model(text,attn_mask) with text = [input_ids, arousal, valence, dom]
+    '''
+
+    def __init__(self,filename):
+
+        self.filename = filename
+        self.onnx = filename.endswith(".onnx")
+
+        if self.onnx:
+            import onnxruntime ## only needed for onnx artifacts
+            self.session = onnxruntime.InferenceSession(filename,providers=["CPUExecutionProvider"])
+        else:
+            self.module = torch.jit.load(filename,map_location="cpu")
+            self.module.eval()
+
+        param_file = os.path.splitext(filename)[0]+".json"
+        self.param = None
+        if os.path.exists(param_file):
+            with open(param_file) as fp:
+                self.param = json.load(fp)
+
+    def __call__(self,text,attn_mask):
+
+        inputs = [text[0],text[1],text[2],text[3],attn_mask]
+
+        if self.onnx:
+            names = ["input_ids","arousal","valence","dom","attn_mask"]
+            logits = self.session.run(["logits"],{name:i.cpu().numpy() for name,i in zip(names,inputs)})[0]
+            return torch.from_numpy(logits)
+
+        with torch.no_grad():
+            return self.module(*[i.cpu() for i in inputs])
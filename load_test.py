@@ -0,0 +1,123 @@
+## Load generator for serve.py, measures latency percentiles and throughput of concurrent clients
+import time
+import json
+import random
+import asyncio
+import argparse
+
+
+sample_texts = ["I finally got the job, I can't believe it!","My dog passed away last night.","Why would anyone leave their trash on my porch?",
+    "Thanks so much, that really made my day.","I'm nervous about the exam tomorrow.","That movie was hilarious.",
+    "I miss the summers we spent at grandma's house.","Ugh, the train is late again.","Wow, I did not expect that at all.",
+    "I'm so proud of my little sister for graduating."]
+
+
+async def post(reader,writer,path,body):
+    body = json.dumps(body).encode()
+    writer.write(f"POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode()+body)
+    await writer.drain()
+    return await read_response(reader)
+
+async def read_response(reader):
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n",b"\n",b""):
+            break
+        key,_,value = line.decode("latin-1").partition(":")
+        if key.strip().lower() == "content-length":
+            length = int(value)
+    return status,json.loads(await reader.readexactly(length))
+
+
+async def client(host,port,texts,inputs_per_request,end,latencies,errors,rng):
+    '''
+    One keep-alive connection sending a request as soon as the previous one is answered, until end
+    '''
+    reader,writer = await asyncio.open_connection(host,port)
+    while time.perf_counter() < end:
+        inputs = [rng.choice(texts) for _ in range(inputs_per_request)]
+        start = time.perf_counter()
+        status,_ = await post(reader,writer,"/predict",{"inputs":inputs})
+        if status == 200:
+            latencies.append(1000*(time.perf_counter()-start))
+        else:
+            errors.append(status)
+    writer.close()
+
+
+async def get_stats(host,port):
+    reader,writer = await asyncio.open_connection(host,port)
+    writer.write(b"GET /stats HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+    await writer.drain()
+    _,stats = await read_response(reader)
+    writer.close()
+    return stats
+
+
+def percentile(values,q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered)-1,int(q/100*len(ordered)))] if ordered else None
+
+
+def format_ms(value):
+    return "n/a" if value is None else f"{value:.1f} ms" ## no successful request
+
+
+async def run_load(host,port,texts,concurrency,duration,inputs_per_request,seed=0):
+    '''
+    concurrency clients for duration seconds, returns the client-side latency percentiles, the throughput and the
+    /stats of the server
+    '''
+    latencies,errors = [],[]
+    before = await get_stats(host,port)
+    start = time.perf_counter()
+    await asyncio.gather(*[client(host,port,texts,inputs_per_request,start+duration,latencies,errors,random.Random(seed+i)) for i in range(concurrency)])
+    elapsed = time.perf_counter()-start
+    after = await get_stats(host,port)
+    batches = after["batches"]-before["batches"] ## the server counts since its start
+
+    return {"concurrency":concurrency,"inputs_per_request":inputs_per_request,"requests":len(latencies),"errors":len(errors),"time":elapsed,
+            "requests_per_sec":len(latencies)/elapsed,"inputs_per_sec":len(latencies)*inputs_per_request/elapsed,
+            "p50_ms":percentile(latencies,50),"p90_ms":percentile(latencies,90),"p99_ms":percentile(latencies,99),"max_ms":max(latencies) if latencies else None,
+            "mean_batch_size":(after["inputs"]-before["inputs"])/max(1,batches),"server":after}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Measure latency and throughput of serve.py under concurrent requests')
+
+    parser.add_argument('--host', default="127.0.0.1",type=str,
+                   help='Enter host of the server')
+    parser.add_argument('-p','--port', default=8000,type=int,
+                   help='Enter port of the server')
+    parser.add_argument('-c', default="1,8,32",type=str,
+                   help='Enter comma separated numbers of concurrent clients, one run each')
+    parser.add_argument('-d', default=10,type=float,
+                   help='Enter duration of every run in seconds')
+    parser.add_argument('-k', default=1,type=int,
+                   help='Enter number of texts per request')
+    parser.add_argument('-i', default=None,type=str,
+                   help='Enter a file with one text per line, sample texts by default')
+    parser.add_argument('-o', default=None,type=str,
+                   help='Enter path of a json file for the results')
+
+    args = parser.parse_args()
+
+    texts = sample_texts
+    if args.i is not None:
+        with open(args.i) as fp:
+            texts = [line.strip() for line in fp if line.strip()]
+        fp.close()
+
+    report = []
+    for concurrency in [int(c) for c in args.c.split(",")]:
+        result = asyncio.run(run_load(args.host,args.port,texts,concurrency,args.d,args.k))
+        report.append(result)
+        print(f'{concurrency} clients: {result["requests_per_sec"]:.1f} requests/s, {result["inputs_per_sec"]:.1f} texts/s, p50 {format_ms(result["p50_ms"])}, p99 {format_ms(result["p99_ms"])}, mean batch size {result["mean_batch_size"]:.1f}, errors {result["errors"]}')
+
+    if args.o is not None:
+        with open(args.o, 'w') as fp:
+            json.dump(report, fp,indent=4)
+        fp.close()
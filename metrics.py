@@ -0,0 +1,219 @@
+## Vectorised evaluation metrics, computed once per epoch from the logits of all batches
+import os
+import json
+import numpy as np
+
+## torch packages
+import torch
+
+## custom
+from distributed import gather_list,is_main_process
+
+
+def prf_divide(numerator,denominator):
+    ## as sklearn with zero_division="warn", 0 where the denominator is 0
+    denominator = np.asarray(denominator,dtype=np.float64)
+    return np.divide(numerator,denominator,out=np.zeros_like(denominator),where=denominator != 0)
+
+
+def f1_from_counts(tp,pred_sum,true_sum,average):
+    '''
+    F1 from the per-class true positive, predicted and true counts, the formula of sklearn.metrics.f1_score. average is
+    None (per class), "macro" or "weighted"
+    '''
+    tp,pred_sum,true_sum = [np.asarray(x,dtype=np.float64) for x in (tp,pred_sum,true_sum)]
+    f1 = prf_divide(2*tp,true_sum+pred_sum)
+    if average is None:
+        return f1
+    if average == "macro":
+        return float(f1.mean())
+    if average == "weighted":
+        return float((f1*true_sum).sum()/true_sum.sum()) if true_sum.sum() > 0 else 0.0
+    raise ValueError(f"unknown average {average}")
+
+
+def save_logits(filename,logits,targets,ids,meta):
+    '''
+    Raw logits (float32), labels (int64, or uint8 rows for multilabel) and example ids of one split in an uncompressed
+    .npz, meta (dataset, output_size, thresholds, ...) is stored as json. Written through a temporary file
+    '''
+    os.makedirs(os.path.dirname(filename) or ".",exist_ok=True)
+    targets = np.asarray(targets)
+    labels = targets.astype(np.uint8) if targets.ndim == 2 else targets.astype(np.int64)
+    with open(filename+".tmp","wb") as f:
+        np.savez(f,logits=np.asarray(logits,dtype=np.float32),labels=labels,ids=np.asarray(ids,dtype=np.int64),meta=np.array(json.dumps(meta)))
+    os.replace(filename+".tmp",filename)
+
+def load_logits(filename):
+    with np.load(filename) as f:
+        return f["logits"],f["labels"],f["ids"],json.loads(str(f["meta"]))
+
+
+class LogitsAccumulator:
+
+    '''
+    Keeps the logits, targets and example ids of every evaluation batch as tensors, gather() concatenates them over the
+    batches and the processes (once, the result is kept)
+    '''
+
+    def __init__(self,num_classes):
+        self.num_classes = num_classes
+        self.logits = []
+        self.targets = []
+        self.ids = []
+        self.gathered = None
+
+    def update(self,logits,target,ids=None):
+        self.logits.append(logits.detach())
+        self.targets.append(target.detach())
+        if ids is not None:
+            self.ids.append(ids)
+        self.gathered = None
+
+    def gather(self):
+        if self.gathered is not None:
+            return self.gathered
+        ## distributed training, every process evaluated its own shard. A process with an empty shard still takes part
+        ## in the gathers with empty tensors, otherwise the others wait for it forever
+        logits = torch.cat([x.float().cpu() for x in self.logits]) if self.logits else torch.zeros(0,self.num_classes)
+        targets = torch.cat([x.cpu() for x in self.targets]) if self.targets else torch.zeros(0)
+        ids = torch.cat([x.long().cpu() for x in self.ids]) if self.ids else torch.zeros(0).long()
+        logits = torch.cat(gather_list([logits]))
+        targets = torch.cat([x for x in gather_list([targets]) if len(x) > 0] or [targets])
+        ids = torch.cat(gather_list([ids]))
+        if len(ids) != len(targets): ## batches without example ids
+            ids = torch.arange(len(targets))
+        self.gathered = logits,targets
+        self.gathered_ids = ids
+        return self.gathered
+
+    def save(self,filename,meta):
+        '''
+        The gathered logits, labels and ids as a save_logits file, written by the first process
+        '''
+        logits,targets = self.gather()
+        if is_main_process():
+            save_logits(filename,logits.numpy(),targets.numpy(),self.gathered_ids.numpy(),meta)
+
+
+class SingleLabelMetrics(LogitsAccumulator):
+
+    '''
+    compute() returns accuracy, top-k accuracy, confusion matrix, per-class counts and macro/weighted F1 over labels
+    '''
+
+    def __init__(self,num_classes,topk=3,labels=None):
+        super(SingleLabelMetrics, self).__init__(num_classes)
+        self.topk = topk
+        self.labels = list(range(num_classes)) if labels is None else list(labels)
+
+    def compute(self):
+
+        logits,targets = self.gather()
+        targets = targets.long()
+        n_examples = targets.size(0)
+        pred = logits.argmax(1)
+
+        conf_matrix = torch.bincount(targets*self.num_classes+pred,minlength=self.num_classes**2).reshape(self.num_classes,self.num_classes)
+        class_correct = conf_matrix.diag()
+        class_total = conf_matrix.sum(1)
+
+        topk = logits.topk(min(self.topk,self.num_classes),1)[1]
+        topk_correct = topk.eq(targets[:,None]).any(1).sum().item()
+
+        ## f1 over self.labels, as f1_score(y_true,y_pred,labels=labels)
+        labels = torch.tensor(self.labels).long()
+        tp = class_correct[labels].numpy()
+        pred_sum = conf_matrix.sum(0)[labels].numpy()
+        true_sum = class_total[labels].numpy()
+
+        return {"examples":n_examples,
+                "accuracy":100.0*class_correct.sum().item()/n_examples,
+                "topk_accuracy":100.0*topk_correct/n_examples,
+                "confusion_matrix":conf_matrix,
+                "class_correct":class_correct,
+                "class_total":class_total,
+                "macro_f1":f1_from_counts(tp,pred_sum,true_sum,"macro"),
+                "weighted_f1":f1_from_counts(tp,pred_sum,true_sum,"weighted")}
+
+
+def multilabel_counts(scores,targets,thresholds):
+    '''
+    Per-class true positive, predicted and true counts of (n_examples, n_classes) score and 0/1 target arrays, a score
+    at or above the threshold of its class is a positive prediction
+    '''
+    pred = scores >= np.asarray(thresholds)[None,:]
+    targets = targets.astype(bool)
+    return (pred & targets).sum(0),pred.sum(0),targets.sum(0)
+
+
+def optimize_thresholds(scores,targets,default=0.3):
+    '''
+    The per-class thresholds with the best F1 on (scores, targets), all classes at once. With the scores of a class
+    sorted in decreasing order, predicting the top k as positive has cumsum(targets)[k-1] true positives, so the F1 of
+    every cut comes from cumulative counts. Cuts fall between distinct scores, the threshold is the midpoint. Classes
+    without a positive example keep default
+    '''
+    n_examples,n_classes = scores.shape
+    thresholds = np.broadcast_to(np.asarray(default,dtype=np.float64),(n_classes,)).copy()
+    if n_examples == 0:
+        return thresholds
+
+    order = np.argsort(-scores,axis=0,kind="stable")
+    sorted_scores = np.take_along_axis(scores,order,axis=0).astype(np.float64)
+    tp = np.cumsum(np.take_along_axis(targets,order,axis=0).astype(np.float64),axis=0)
+    true_sum = tp[-1]
+    k = np.arange(1,n_examples+1,dtype=np.float64)[:,None]
+    f1 = prf_divide(2*tp,true_sum[None,:]+k)
+
+    ## a cut inside a run of equal scores cannot be reached by a threshold
+    valid = np.ones_like(f1,dtype=bool)
+    valid[:-1] = sorted_scores[:-1] != sorted_scores[1:]
+    f1 = np.where(valid,f1,-1)
+
+    best = f1.argmax(0)
+    columns = np.arange(n_classes)
+    lowest_positive = sorted_scores[best,columns]
+    highest_negative = np.where(best+1 < n_examples,sorted_scores[np.minimum(best+1,n_examples-1),columns],-np.inf)
+    midpoint = (lowest_positive+highest_negative)/2
+    ## the midpoint rounds onto the highest negative score for adjacent floats, and is -inf when every example is positive
+    tuned = np.where(midpoint > highest_negative,midpoint,lowest_positive)
+
+    thresholds = np.where(true_sum > 0,tuned,thresholds)
+    return thresholds
+
+
+class MultiLabelMetrics(LogitsAccumulator):
+
+    '''
+    compute(thresholds) returns macro precision/recall/F1 and per-class accuracy/precision/recall/F1 of the sigmoid
+    scores, thresholds is one float for every class or a list with one per class
+    '''
+
+    def compute(self,thresholds=0.3,tune=False):
+
+        logits,targets = self.gather()
+        scores = torch.sigmoid(logits).numpy()
+        targets = targets.numpy()
+
+        if tune: ## tuned on these scores, e.g. the validation split
+            thresholds = optimize_thresholds(scores,targets,thresholds)
+        thresholds = np.broadcast_to(np.asarray(thresholds,dtype=np.float64),(self.num_classes,))
+
+        tp,pred_sum,true_sum = multilabel_counts(scores,targets,thresholds)
+        n_examples = scores.shape[0]
+        tn = n_examples-pred_sum-true_sum+tp
+
+        precision = prf_divide(tp,pred_sum)
+        recall = prf_divide(tp,true_sum)
+        f1 = f1_from_counts(tp,pred_sum,true_sum,None)
+
+        return {"examples":n_examples,
+                "precision":float(precision.mean()),
+                "recall":float(recall.mean()),
+                "f1":float(f1.mean()),
+                "class_accuracy":(tp+tn)/max(1,n_examples),
+                "class_precision":precision,
+                "class_recall":recall,
+                "class_f1":f1,
+                "thresholds":thresholds.tolist()}
@@ -7,38 +7,96 @@ import torch
 import torch.nn as nn
 from torch.utils import checkpoint
 
-from transformers import ElectraForSequenceClassification,BertForSequenceClassification
+import transformers
+from transformers import ElectraModel,BertModel
 from torch.autograd import Variable
 from torch.nn import functional as F
 import time
 
 
+def upgrade_state_dict(state_dict):
+    '''
+    Maps checkpoints saved when the encoder was a *ForSequenceClassification model onto the bare encoder layout,
+    encoder.bert.* / encoder.electra.* --> encoder.*, and drops the unused classification head (encoder.classifier.*)
+    and the BERT pooler (encoder.pooler.*), which the encoders are built without
+    '''
+    new_state_dict = {}
+    for key, value in state_dict.items():
+        if key.startswith("encoder.classifier."):
+            continue
+        for prefix in ["encoder.bert.","encoder.electra."]:
+            if key.startswith(prefix):
+                key = "encoder."+key[len(prefix):]
+        if key.startswith("encoder.pooler."):
+            continue
+        new_state_dict[key] = value
+
+    return new_state_dict
+
+
+def enable_gradient_checkpointing(encoder):
+    '''
+    Recompute the activations of every encoder layer in backward instead of keeping them alive for autograd
+    '''
+    if hasattr(encoder,"gradient_checkpointing_enable"):
+        encoder.gradient_checkpointing_enable()
+    else: ## older transformers read the flag from the config
+        encoder.config.gradient_checkpointing = True
+
+
+def encode_input(encoder,text,attn_mask):
+    '''
+    Returns the last hidden states for the KEA head (one row per example) and their padding mask, from token ids, from
+    cached hidden states of a frozen encoder (see encoder_cache.py) or from packed rows (see dataset.packed_collate_fn)
+    '''
+    if text[0].dim() == 3: ## cached last hidden states of the frozen encoder
+        return text[0].float(),attn_mask
+
+    if attn_mask.dim() == 3: ## packed rows with a block-diagonal mask, text[4] position ids, text[5] packed_index
+        if int(transformers.__version__.split(".")[0]) >= 5: ## takes a prepared additive (batch,1,L,L) mask instead of a 3-d one
+            dtype = next(encoder.parameters()).dtype
+            attn_mask = (1.0-attn_mask[:,None].to(dtype))*torch.finfo(dtype).min
+        output = encoder(text[0],attn_mask,position_ids=text[4],return_dict=True).last_hidden_state
+        packed_index = text[5]
+        input = output.reshape(-1,output.size()[2])[packed_index.clamp(min=0)] ## unpacked, one row per example
+        return input,(packed_index >= 0).long()
+
+    return encoder(text[0],attn_mask,return_dict=True).last_hidden_state,attn_mask
+
+
 class KEA_BERT(nn.Module):
 
-    def __init__(self,batch_size,output_size,hidden_size):
+    def __init__(self,batch_size,output_size,hidden_size,grad_checkpoint=False,max_len=512):
         super(KEA_BERT, self).__init__()
 
 
         options_name = "bert-base-uncased"
-        self.encoder = BertForSequenceClassification.from_pretrained(options_name,num_labels=output_size)
+        self.encoder = BertModel.from_pretrained(options_name,add_pooling_layer=False) ## bare encoder without the pooler, only its last hidden state is used
 
         self.batch_size = batch_size
         self.output_size = output_size
         self.hidden_size = hidden_size
 
-        self.a = nn.Linear(512,hidden_size) #512 is the size of lexicon_vec
-        self.v = nn.Linear(512,hidden_size) #512 is the size of lexicon_vec
-        self.d = nn.Linear(512,hidden_size) #512 is the size of lexicon_vec
+        self.grad_checkpoint = grad_checkpoint
+        if grad_checkpoint:
+            enable_gradient_checkpointing(self.encoder)
+
+        self.max_len = max_len
+        self.a = nn.Linear(max_len,hidden_size) #max_len is the size of lexicon_vec, collate_fn pads it to max_len
+        self.v = nn.Linear(max_len,hidden_size)
+        self.d = nn.Linear(max_len,hidden_size)
 
         self.dropout = nn.Dropout(0.1)
         self.fc1 = nn.Linear(hidden_size,384)
         self.label = nn.Linear(384,output_size)
 
-    def attention_net(self,input_matrix, final_output):
+    def attention_net(self,input_matrix, final_output,mask=None):
 
         hidden = final_output
 
         attn_weights = torch.bmm(input_matrix, hidden.unsqueeze(2)).squeeze(2)
+        if mask is not None: ## padding positions get no attention
+            attn_weights = attn_weights.masked_fill(mask == 0,float("-inf"))
 
         soft_attn_weights = F.softmax(attn_weights, 1)
 
@@ -49,7 +107,7 @@ class KEA_BERT(nn.Module):
 
     def forward(self,text,attn_mask):
 
-        input = self.encoder(text[0],attn_mask,output_hidden_states=True,return_dict=True).hidden_states[-1]
+        input,attn_mask = encode_input(self.encoder,text,attn_mask)
 
         cls_input = input[:,0,:]
 
@@ -59,8 +117,9 @@ class KEA_BERT(nn.Module):
         dom_encoder = F.relu(self.d(text[3]))
 
         input = torch.cat((input,arousal_encoder.unsqueeze(1),valence_encoder.unsqueeze(1),dom_encoder.unsqueeze(1)),dim=1)
+        mask = torch.cat((attn_mask,attn_mask.new_ones(attn_mask.size()[0],3)),dim=1) # lexicon vectors are never masked
         # input = self.layernorm(input)
-        output = self.attention_net(input,cls_input)
+        output = self.attention_net(input,cls_input,mask)
         output = F.relu(self.fc1(output))
         output = self.dropout(output)
         logits = self.label(output)
@@ -71,30 +130,37 @@ class KEA_BERT(nn.Module):
 
 class KEA_ELECTRA(nn.Module):
 
-    def __init__(self,batch_size,output_size,hidden_size):
+    def __init__(self,batch_size,output_size,hidden_size,grad_checkpoint=False,max_len=512):
         super(KEA_ELECTRA, self).__init__()
 
 
         options_name = "google/electra-base-discriminator"
-        self.encoder = ElectraForSequenceClassification.from_pretrained(options_name,num_labels=output_size)
+        self.encoder = ElectraModel.from_pretrained(options_name) ## bare encoder, only its last hidden state is used
 
         self.batch_size = batch_size
         self.output_size = output_size
         self.hidden_size = hidden_size
 
-        self.a = nn.Linear(512,hidden_size) #512 is the size of lexicon_vec
-        self.v = nn.Linear(512,hidden_size) #512 is the size of lexicon_vec
-        self.d = nn.Linear(512,hidden_size) #512 is the size of lexicon_vec
+        self.grad_checkpoint = grad_checkpoint
+        if grad_checkpoint:
+            enable_gradient_checkpointing(self.encoder)
+
+        self.max_len = max_len
+        self.a = nn.Linear(max_len,hidden_size) #max_len is the size of lexicon_vec, collate_fn pads it to max_len
+        self.v = nn.Linear(max_len,hidden_size)
+        self.d = nn.Linear(max_len,hidden_size)
 
         self.dropout = nn.Dropout(0.1)
         self.fc1 = nn.Linear(hidden_size,384)
         self.label = nn.Linear(384,output_size)
 
-    def attention_net(self,input_matrix, final_output):
+    def attention_net(self,input_matrix, final_output,mask=None):
 
         hidden = final_output
 
         attn_weights = torch.bmm(input_matrix, hidden.unsqueeze(2)).squeeze(2)
+        if mask is not None: ## padding positions get no attention
+            attn_weights = attn_weights.masked_fill(mask == 0,float("-inf"))
 
         soft_attn_weights = F.softmax(attn_weights, 1)
 
@@ -105,7 +171,7 @@ class KEA_ELECTRA(nn.Module):
 
     def forward(self,text,attn_mask):
 
-        input = self.encoder(text[0],attn_mask,output_hidden_states=True,return_dict=True).hidden_states[-1]
+        input,attn_mask = encode_input(self.encoder,text,attn_mask)
 
         cls_input = input[:,0,:]
 
@@ -115,7 +181,8 @@ class KEA_ELECTRA(nn.Module):
         dom_encoder = F.relu(self.d(text[3]))
 
         input = torch.cat((input,arousal_encoder.unsqueeze(1),valence_encoder.unsqueeze(1),dom_encoder.unsqueeze(1)),dim=1)
-        output = self.attention_net(input,cls_input)
+        mask = torch.cat((attn_mask,attn_mask.new_ones(attn_mask.size()[0],3)),dim=1) # lexicon vectors are never masked
+        output = self.attention_net(input,cls_input,mask)
         output = F.relu(self.fc1(output))
         output = self.dropout(output)
         logits = self.label(output)
@@ -125,27 +192,33 @@ class KEA_ELECTRA(nn.Module):
 
 class KEA_Electra_Word_level(nn.Module):
 
-    def __init__(self,batch_size,output_size,hidden_size):
+    def __init__(self,batch_size,output_size,hidden_size,grad_checkpoint=False):
         super(KEA_Electra_Word_level, self).__init__()
 
 
         options_name = "google/electra-base-discriminator"
-        self.encoder = ElectraForSequenceClassification.from_pretrained(options_name,num_labels=output_size)
+        self.encoder = ElectraModel.from_pretrained(options_name) ## bare encoder, only its last hidden state is used
 
         self.batch_size = batch_size
         self.output_size = output_size
         self.hidden_size = hidden_size
 
+        self.grad_checkpoint = grad_checkpoint
+        if grad_checkpoint:
+            enable_gradient_checkpointing(self.encoder)
+
         self.bilstm = nn.LSTM(hidden_size+3,int(hidden_size/2), dropout=0.2, bidirectional=True)
         self.dropout = nn.Dropout(0.1)
         self.fc1 = nn.Linear(hidden_size,384)
         self.label = nn.Linear(384,output_size)
 
-    def attention_net(self,input_matrix, final_output):
+    def attention_net(self,input_matrix, final_output,mask=None):
 
         hidden = final_output
 
         attn_weights = torch.bmm(input_matrix, hidden.unsqueeze(2)).squeeze(2)
+        if mask is not None: ## padding positions get no attention
+            attn_weights = attn_weights.masked_fill(mask == 0,float("-inf"))
 
         soft_attn_weights = F.softmax(attn_weights, 1)
 
@@ -154,9 +227,28 @@ class KEA_Electra_Word_level(nn.Module):
         return new_hidden_state
 
 
+    def bilstm_block(self,word_query,attn_mask):
+
+        seq_len = word_query.size()[1]
+
+        h_0 = word_query.new_zeros(2, word_query.size()[0],int(self.hidden_size/2)) # same device as the encoder output
+        c_0 = word_query.new_zeros(2, word_query.size()[0],int(self.hidden_size/2))
+
+        ## packed by the true sequence lengths, so the BiLSTM never runs over padding
+        word_query = word_query.permute(1, 0, 2)
+        word_query = nn.utils.rnn.pack_padded_sequence(word_query,attn_mask.sum(1).cpu(),enforce_sorted=False)
+
+        output, (h_n, c_n) = self.bilstm(word_query, (h_0, c_0))
+
+        output,_ = nn.utils.rnn.pad_packed_sequence(output,total_length=seq_len)
+        output = output.permute(1, 0, 2)
+
+        return output
+
+
     def forward(self,text,attn_mask):
 
-        input = self.encoder(text[0],attn_mask,output_hidden_states=True,return_dict=True).hidden_states[-1]
+        input,attn_mask = encode_input(self.encoder,text,attn_mask)
 
         cls_input = input[:,0,:]
         # print(input.size())
@@ -165,16 +257,12 @@ class KEA_Electra_Word_level(nn.Module):
         word_query = torch.cat((input,text[1][:,:seq_len].unsqueeze(2),text[2][:,:seq_len].unsqueeze(2),text[3][:,:seq_len].unsqueeze(2)),dim=2)
 
 
-        h_0 = Variable(torch.zeros(2, input.size()[0],int(self.hidden_size/2)).cuda())
-        c_0 = Variable(torch.zeros(2, input.size()[0],int(self.hidden_size/2)).cuda())
+        if self.grad_checkpoint and word_query.requires_grad: ## BiLSTM activations are recomputed in backward
+            output = checkpoint.checkpoint(self.bilstm_block,word_query,attn_mask,use_reentrant=False) ## non-reentrant, DistributedDataParallel marks every parameter ready once
+        else:
+            output = self.bilstm_block(word_query,attn_mask)
 
-
-        word_query = word_query.permute(1, 0, 2)
-
-        output, (h_n, c_n) = self.bilstm(word_query, (h_0, c_0))
-
-        output = output.permute(1, 0, 2)
-        output = self.attention_net(output,cls_input)
+        output = self.attention_net(output,cls_input,attn_mask)
         output = F.relu(self.fc1(output))
         output = self.dropout(output)
         logits = self.label(output)
@@ -183,27 +271,33 @@ class KEA_Electra_Word_level(nn.Module):
 
 class KEA_Bert_Word_level(nn.Module):
 
-    def __init__(self,batch_size,output_size,hidden_size):
+    def __init__(self,batch_size,output_size,hidden_size,grad_checkpoint=False):
         super(KEA_Bert_Word_level, self).__init__()
 
 
         options_name = "bert-base-uncased"
-        self.encoder = BertForSequenceClassification.from_pretrained(options_name,num_labels=output_size)
+        self.encoder = BertModel.from_pretrained(options_name,add_pooling_layer=False) ## bare encoder without the pooler, only its last hidden state is used
 
         self.batch_size = batch_size
         self.output_size = output_size
         self.hidden_size = hidden_size
 
+        self.grad_checkpoint = grad_checkpoint
+        if grad_checkpoint:
+            enable_gradient_checkpointing(self.encoder)
+
         self.bilstm = nn.LSTM(hidden_size+3,int(hidden_size/2), dropout=0.2, bidirectional=True)
         self.dropout = nn.Dropout(0.1)
         self.fc1 = nn.Linear(hidden_size,384)
         self.label = nn.Linear(384,output_size)
 
-    def attention_net(self,input_matrix, final_output):
+    def attention_net(self,input_matrix, final_output,mask=None):
 
         hidden = final_output
 
         attn_weights = torch.bmm(input_matrix, hidden.unsqueeze(2)).squeeze(2)
+        if mask is not None: ## padding positions get no attention
+            attn_weights = attn_weights.masked_fill(mask == 0,float("-inf"))
 
         soft_attn_weights = F.softmax(attn_weights, 1)
 
@@ -212,9 +306,28 @@ class KEA_Bert_Word_level(nn.Module):
         return new_hidden_state
 
 
+    def bilstm_block(self,word_query,attn_mask):
+
+        seq_len = word_query.size()[1]
+
+        h_0 = word_query.new_zeros(2, word_query.size()[0],int(self.hidden_size/2)) # same device as the encoder output
+        c_0 = word_query.new_zeros(2, word_query.size()[0],int(self.hidden_size/2))
+
+        ## packed by the true sequence lengths, so the BiLSTM never runs over padding
+        word_query = word_query.permute(1, 0, 2)
+        word_query = nn.utils.rnn.pack_padded_sequence(word_query,attn_mask.sum(1).cpu(),enforce_sorted=False)
+
+        output, (h_n, c_n) = self.bilstm(word_query, (h_0, c_0))
+
+        output,_ = nn.utils.rnn.pad_packed_sequence(output,total_length=seq_len)
+        output = output.permute(1, 0, 2)
+
+        return output
+
+
     def forward(self,text,attn_mask):
 
-        input = self.encoder(text[0],attn_mask,output_hidden_states=True,return_dict=True).hidden_states[-1]
+        input,attn_mask = encode_input(self.encoder,text,attn_mask)
 
         cls_input = input[:,0,:]
         seq_len = input.size()[1]
@@ -222,15 +335,90 @@ class KEA_Bert_Word_level(nn.Module):
         word_query = torch.cat((input,text[1][:,:seq_len].unsqueeze(2),text[2][:,:seq_len].unsqueeze(2),text[3][:,:seq_len].unsqueeze(2)),dim=2)
 
 
-        h_0 = Variable(torch.zeros(2, input.size()[0],int(self.hidden_size/2)).cuda())
-        c_0 = Variable(torch.zeros(2, input.size()[0],int(self.hidden_size/2)).cuda())
+        if self.grad_checkpoint and word_query.requires_grad: ## BiLSTM activations are recomputed in backward
+            output = checkpoint.checkpoint(self.bilstm_block,word_query,attn_mask,use_reentrant=False) ## non-reentrant, DistributedDataParallel marks every parameter ready once
+        else:
+            output = self.bilstm_block(word_query,attn_mask)
 
-        word_query = word_query.permute(1, 0, 2)
+        output = self.attention_net(output,cls_input,attn_mask)
+        output = F.relu(self.fc1(output))
+        output = self.dropout(output)
+        logits = self.label(output)
 
-        output, (h_n, c_n) = self.bilstm(word_query, (h_0, c_0))
+        return logits
 
-        output = output.permute(1, 0, 2)
-        output = self.attention_net(output,cls_input)
+
+class KEA_Electra_Turn_level(nn.Module):
+
+    '''
+    Hierarchical KEA for long conversations: every turn is encoded separately (all turns of the batch in one encoder
+    call, see dataset.turn_collate_fn) and pooled with the sentence-level KEA attention over its tokens and lexicon
+    vectors, then the turn embeddings of each conversation are pooled with the same attention
+    '''
+
+    def __init__(self,batch_size,output_size,hidden_size,grad_checkpoint=False,max_len=512):
+        super(KEA_Electra_Turn_level, self).__init__()
+
+
+        options_name = "google/electra-base-discriminator"
+        self.encoder = ElectraModel.from_pretrained(options_name) ## bare encoder, only its last hidden state is used
+
+        self.batch_size = batch_size
+        self.output_size = output_size
+        self.hidden_size = hidden_size
+
+        self.grad_checkpoint = grad_checkpoint
+        if grad_checkpoint:
+            enable_gradient_checkpointing(self.encoder)
+
+        self.max_len = max_len
+        self.a = nn.Linear(max_len,hidden_size) #max_len is the size of the lexicon_vec of a turn
+        self.v = nn.Linear(max_len,hidden_size)
+        self.d = nn.Linear(max_len,hidden_size)
+
+        self.dropout = nn.Dropout(0.1)
+        self.fc1 = nn.Linear(hidden_size,384)
+        self.label = nn.Linear(384,output_size)
+
+    def attention_net(self,input_matrix, final_output,mask=None):
+
+        hidden = final_output
+
+        attn_weights = torch.bmm(input_matrix, hidden.unsqueeze(2)).squeeze(2)
+        if mask is not None: ## padding positions get no attention
+            attn_weights = attn_weights.masked_fill(mask == 0,float("-inf"))
+
+        soft_attn_weights = F.softmax(attn_weights, 1)
+
+        new_hidden_state = torch.bmm(input_matrix.transpose(1, 2), soft_attn_weights.unsqueeze(2)).squeeze(2)
+
+        return new_hidden_state
+
+
+    def forward(self,text,attn_mask):
+
+        ## text = [turn tokens, turn arousal, turn valence, turn dom, turn_index], one row per turn of the batch,
+        ## turn_index (conversations x turns) holds the row of every turn of a conversation, -1 for padding
+        turn_index = text[4]
+
+        input = self.encoder(text[0],attn_mask,return_dict=True).last_hidden_state
+
+        cls_input = input[:,0,:]
+
+        arousal_encoder = F.relu(self.a(text[1]))
+        valence_encoder = F.relu(self.v(text[2]))
+        dom_encoder = F.relu(self.d(text[3]))
+
+        input = torch.cat((input,arousal_encoder.unsqueeze(1),valence_encoder.unsqueeze(1),dom_encoder.unsqueeze(1)),dim=1)
+        mask = torch.cat((attn_mask,attn_mask.new_ones(attn_mask.size()[0],3)),dim=1) # lexicon vectors are never masked
+        turn_output = self.attention_net(input,cls_input,mask)
+
+        ## conversation level, the mean of the turn embeddings is the query
+        turn_mask = (turn_index >= 0).long()
+        turns = turn_output[turn_index.clamp(min=0)]*turn_mask.unsqueeze(2)
+        conversation_query = turns.sum(1)/turn_mask.sum(1,keepdim=True)
+
+        output = self.attention_net(turns,conversation_query,turn_mask)
         output = F.relu(self.fc1(output))
         output = self.dropout(output)
         logits = self.label(output)
@@ -238,7 +426,79 @@ class KEA_Bert_Word_level(nn.Module):
         return logits
 
 
+class KEA_Bert_Turn_level(nn.Module):
+
+    '''
+    Hierarchical KEA for long conversations: every turn is encoded separately (all turns of the batch in one encoder
+    call, see dataset.turn_collate_fn) and pooled with the sentence-level KEA attention over its tokens and lexicon
+    vectors, then the turn embeddings of each conversation are pooled with the same attention
+    '''
+
+    def __init__(self,batch_size,output_size,hidden_size,grad_checkpoint=False,max_len=512):
+        super(KEA_Bert_Turn_level, self).__init__()
+
+
+        options_name = "bert-base-uncased"
+        self.encoder = BertModel.from_pretrained(options_name,add_pooling_layer=False) ## bare encoder without the pooler, only its last hidden state is used
+
+        self.batch_size = batch_size
+        self.output_size = output_size
+        self.hidden_size = hidden_size
+
+        self.grad_checkpoint = grad_checkpoint
+        if grad_checkpoint:
+            enable_gradient_checkpointing(self.encoder)
+
+        self.max_len = max_len
+        self.a = nn.Linear(max_len,hidden_size) #max_len is the size of the lexicon_vec of a turn
+        self.v = nn.Linear(max_len,hidden_size)
+        self.d = nn.Linear(max_len,hidden_size)
 
+        self.dropout = nn.Dropout(0.1)
+        self.fc1 = nn.Linear(hidden_size,384)
+        self.label = nn.Linear(384,output_size)
+
+    def attention_net(self,input_matrix, final_output,mask=None):
+
+        hidden = final_output
+
+        attn_weights = torch.bmm(input_matrix, hidden.unsqueeze(2)).squeeze(2)
+        if mask is not None: ## padding positions get no attention
+            attn_weights = attn_weights.masked_fill(mask == 0,float("-inf"))
 
+        soft_attn_weights = F.softmax(attn_weights, 1)
+
+        new_hidden_state = torch.bmm(input_matrix.transpose(1, 2), soft_attn_weights.unsqueeze(2)).squeeze(2)
+
+        return new_hidden_state
+
+
+    def forward(self,text,attn_mask):
 
+        ## text = [turn tokens, turn arousal, turn valence, turn dom, turn_index], one row per turn of the batch,
+        ## turn_index (conversations x turns) holds the row of every turn of a conversation, -1 for padding
+        turn_index = text[4]
 
+        input = self.encoder(text[0],attn_mask,return_dict=True).last_hidden_state
+
+        cls_input = input[:,0,:]
+
+        arousal_encoder = F.relu(self.a(text[1]))
+        valence_encoder = F.relu(self.v(text[2]))
+        dom_encoder = F.relu(self.d(text[3]))
+
+        input = torch.cat((input,arousal_encoder.unsqueeze(1),valence_encoder.unsqueeze(1),dom_encoder.unsqueeze(1)),dim=1)
+        mask = torch.cat((attn_mask,attn_mask.new_ones(attn_mask.size()[0],3)),dim=1) # lexicon vectors are never masked
+        turn_output = self.attention_net(input,cls_input,mask)
+
+        ## conversation level, the mean of the turn embeddings is the query
+        turn_mask = (turn_index >= 0).long()
+        turns = turn_output[turn_index.clamp(min=0)]*turn_mask.unsqueeze(2)
+        conversation_query = turns.sum(1)/turn_mask.sum(1,keepdim=True)
+
+        output = self.attention_net(turns,conversation_query,turn_mask)
+        output = F.relu(self.fc1(output))
+        output = self.dropout(output)
+        logits = self.label(output)
+
+        return logits
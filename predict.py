@@ -0,0 +1,168 @@
+## Batch inference over raw text with a model_best.pth.tar checkpoint, see README
+import json
+import argparse
+import functools
+
+## torch packages
+import torch
+from transformers import AutoTokenizer
+
+## custom
+from select_model_input import load_model,select_input,get_device
+from preprocess import tokenize_conversation,tokenize_cause
+from extract_lexicon import get_vad_table
+from dataset import collate_fn,packed_collate_fn,turn_collate_fn
+from label_dict import ed_emo_dict,goemotions_emo_dict,semeval_emo_dict
+
+
+emo_dicts = {"ed":ed_emo_dict,"goemotions":goemotions_emo_dict,"semeval":semeval_emo_dict}
+
+
+class EmotionClassifier:
+
+    '''
+    Loads a model_best.pth.tar, its param dict, the tokenizer and the lexicon table once and classifies raw texts. An
+    input is a string or a dialogue, a list of utterances alternating between speaker and listener (as in ED).
+    Inputs are tokenized as by preprocess.py and batched by length, so short inputs are not padded to long ones
+    '''
+
+    def __init__(self,filename,device=None,batch_size=32,tokenizer_type="bert-base-uncased"):
+
+        self.model,self.config = load_model(filename,device)
+        self.model.eval()
+        self.device = get_device(self.config)
+        self.batch_size = batch_size
+
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_type)
+        get_vad_table(self.tokenizer) ## loaded (or built) now rather than by the first request
+
+        self.max_len = self.config.get("max_len",512)
+        self.truncation = self.config.get("truncation","head")
+        self.multilabel = self.config.dataset != "ed"
+        emo_dict = emo_dicts.get(self.config.dataset,{})
+        self.labels = [emo_dict.get(i,str(i)) for i in range(self.config.output_size)]
+
+        ## tuned per-class thresholds saved with the checkpoint, otherwise the fixed threshold of the config
+        thresholds = self.config.thresholds if self.config.get("thresholds") is not None else self.config.get("threshold",0.3)
+        self.thresholds = torch.tensor(thresholds).float().expand(self.config.output_size)
+
+        if self.config.arch_name.endswith("_turn"):
+            self.collate = functools.partial(turn_collate_fn,max_len=self.max_len,truncation=self.truncation)
+        else:
+            self.collate = functools.partial(packed_collate_fn if self.config.get("packing",False) else collate_fn,max_len=self.max_len,truncation=self.truncation)
+
+    def encode(self,inputs):
+        '''
+        One dataset item (as ED_dataset/ED_turn_dataset/GoEmo_dataset.__getitem__) per input, with a dummy label
+        '''
+        dialogues = [[x] if isinstance(x,str) else list(x) for x in inputs]
+        turn_level = self.config.arch_name.endswith("_turn")
+        emotion = torch.zeros(self.config.output_size) if self.multilabel else 0
+
+        ## a single utterance tokenizes the same either way, strings are tokenized together in one call
+        single = [i for i,dialogue in enumerate(dialogues) if len(dialogue) == 1 and not turn_level]
+        tokenized = dict(zip(single,tokenize_cause(self.tokenizer,[dialogues[i][0] for i in single],self.max_len,self.truncation))) if single else {}
+
+        items = []
+        for index,dialogue in enumerate(dialogues):
+            item = {"utterance_data_str":dialogue,"emotion":emotion,"index":index}
+            if turn_level:
+                _,turn_data,*_,turn_vad = tokenize_conversation(self.tokenizer,dialogue)
+                item["turn_data"] = [torch.LongTensor(turn) for turn in turn_data]
+                item["turn_arousal_data"],item["turn_valence_data"],item["turn_dom_data"] = [[torch.Tensor(vec) for vec in vecs] for vecs in turn_vad]
+            else:
+                if index in tokenized:
+                    tokens,arousal,valence,dom = tokenized[index]
+                else:
+                    *_,tokens,arousal,valence,dom,turn_vad = tokenize_conversation(self.tokenizer,dialogue,self.max_len,self.truncation)
+                item["utterance_data"] = torch.LongTensor(tokens)
+                item["arousal_data"],item["valence_data"],item["dom_data"] = torch.Tensor(arousal),torch.Tensor(valence),torch.Tensor(dom)
+            items.append(item)
+
+        return items
+
+    def get_lengths(self,items):
+        if self.config.arch_name.endswith("_turn"): ## padded turn tokens, as ED_turn_dataset.get_lengths
+            return [len(item["turn_data"])*max(len(turn) for turn in item["turn_data"]) for item in items]
+        return [min(len(item["utterance_data"]),self.max_len) for item in items]
+
+    def predict_logits(self,inputs):
+        '''
+        Logits of the inputs (n_inputs, output_size), in the order of inputs
+        '''
+        items = self.encode(inputs)
+        lengths = self.get_lengths(items)
+        order = sorted(range(len(items)),key=lambda i: lengths[i],reverse=True)
+
+        logits = torch.zeros(len(items),self.config.output_size)
+        with torch.no_grad():
+            for start in range(0,len(order),self.batch_size):
+                batch = self.collate([items[i] for i in order[start:start+self.batch_size]])
+                text,attn,_ = select_input(batch,self.config)
+                text = [t.to(self.device) for t in text]
+                attn = attn.to(self.device)
+
+                logits[batch["index"]] = self.model(text,attn).float().cpu()
+
+        return logits
+
+    def predict(self,inputs):
+        '''
+        One result per input: the label and the softmax probability of every label for ED, the labels at or above
+        their threshold and the sigmoid score of every label for the multilabel datasets
+        '''
+        if len(inputs) == 0:
+            return []
+        logits = self.predict_logits(inputs)
+
+        results = []
+        if self.multilabel:
+            scores = torch.sigmoid(logits)
+            for row in scores:
+                results.append({"labels":[self.labels[i] for i in torch.nonzero(row >= self.thresholds).flatten().tolist()],
+                                "probabilities":dict(zip(self.labels,row.tolist()))})
+        else:
+            scores = torch.softmax(logits,1)
+            for row in scores:
+                results.append({"label":self.labels[row.argmax().item()],"probabilities":dict(zip(self.labels,row.tolist()))})
+
+        return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Classify the emotions of raw texts with a trained model')
+
+    parser.add_argument('-c', type=str, required=True,
+                   help='Enter the path of model_best.pth.tar')
+    parser.add_argument('-i', type=str, required=True,
+                   help='Enter the input file, one text per line or one json list of utterances (a dialogue) per line')
+    parser.add_argument('-o', default=None,type=str,
+                   help='Enter path of a json lines file for the results, printed by default')
+    parser.add_argument('-b', default=32,type=int,
+                   help='Enter batch size')
+    parser.add_argument('-t', default="bert-base-uncased",type=str,
+                   help='Enter tokenizer type, the one of preprocess.py')
+    parser.add_argument('-d', default=None,type=str,
+                   help='Enter device, defaults to cuda when available')
+
+    args = parser.parse_args()
+
+    inputs = []
+    with open(args.i) as fp:
+        for line in fp:
+            line = line.strip()
+            if line:
+                inputs.append(json.loads(line) if line.startswith("[") else line)
+    fp.close()
+
+    classifier = EmotionClassifier(args.c,args.d,args.b,args.t)
+    results = classifier.predict(inputs)
+
+    lines = [json.dumps(result) for result in results]
+    if args.o is not None:
+        with open(args.o, 'w') as fp:
+            fp.write("\n".join(lines)+"\n")
+        fp.close()
+    else:
+        print("\n".join(lines))
@@ -3,6 +3,8 @@ import pandas as pd
 import numpy as np
 import pickle
 import argparse
+import multiprocessing
+import functools
 
 ## torch packages
 import torch
@@ -13,8 +15,9 @@ import matplotlib.pyplot as plt
 import collections
 
 ## custom packages
-from extract_lexicon import get_arousal_vec,get_valence_vec,get_dom_vec
-from utils import flatten_list,tweet_preprocess
+from extract_lexicon import get_vad_batch
+from utils import flatten_list,chunk_list,tweet_preprocess,truncate_sequence
+from dataset import save_columnar
 
 
 emo_map = {'surprised': 0, 'excited': 1, 'annoyed': 2, 'proud': 3, 'angry': 4, 'sad': 5, 'grateful': 6, 'lonely': 7,
@@ -131,46 +134,85 @@ def data_reader(data_folder, datatype,save=True):
     return processed_data
 
 
-def tokenize_data(processed_data,tokenizer_type="bert-base-uncased"):
-    tokenizer = AutoTokenizer.from_pretrained(tokenizer_type)
+## one tokenizer per pool worker, loaded once by init_worker
+worker_tokenizer = None
 
-    tokenized_inter_speaker, tokenized_inter_listener = [],[]
-    tokenized_total_data,tokenized_speaker,tokenized_listener = [],[],[]
-    tokenized_list_data,tokenized_turn_data = [],[]
-    arousal_data,valence_data,dom_data = [],[],[]
+def init_worker(tokenizer_type):
+    global worker_tokenizer
+    worker_tokenizer = AutoTokenizer.from_pretrained(tokenizer_type)
+
+def get_pool(tokenizer_type,workers):
+    '''
+    Returns a process pool whose workers each hold their own tokenizer, None for the serial path
+    '''
+    if workers is None or workers <= 1:
+        return None
+    return multiprocessing.Pool(workers,initializer=init_worker,initargs=(tokenizer_type,))
+
+def run_sharded(shard_fn,data,pool,shard_size=1000):
+    '''
+    Splits data into contiguous shards, processes them in the pool and merges the results back in order
+    '''
+    shards = chunk_list(data,shard_size)
+    return flatten_list(pool.map(shard_fn,shards))
 
-    for u,val_utterance in enumerate(processed_data["utterance_data_list"]): #val utterance is one conversation which has multiple utterances
 
-        tokenized_i= tokenizer.batch_encode_plus(val_utterance,add_special_tokens=False)["input_ids"]
+def tokenize_conversation(tokenizer,val_utterance,max_len=None,truncation="head"): #val utterance is one conversation which has multiple utterances
 
-        speaker_utterance,listener_utterance,speaker_iutterance,listener_iutterance,total_utterance = [101],[101],[101],[101],[101]
+    tokenized_i= tokenizer.batch_encode_plus(val_utterance,add_special_tokens=False)["input_ids"]
 
-        total_utterance_list = []
+    speaker_utterance,listener_utterance,speaker_iutterance,listener_iutterance,total_utterance = [101],[101],[101],[101],[101]
 
-        for s,val_speaker in enumerate(tokenized_i): ## for each utterance inside a conversation
+    total_utterance_list = []
 
-            if s%2 == 0: # when person is the "speaker"
-                speaker_utterance.extend(val_speaker+[102])
-                speaker_iutterance.extend(val_speaker+[102])
-                listener_iutterance.extend([0 for _ in range(len(val_speaker))]+[102])
-    #
-            else:
-                listener_utterance.extend(val_speaker+[102])
-                listener_iutterance.extend(val_speaker+[102])
-                speaker_iutterance.extend([0 for _ in range(len(val_speaker))]+[102])
+    for s,val_speaker in enumerate(tokenized_i): ## for each utterance inside a conversation
+
+        if s%2 == 0: # when person is the "speaker"
+            speaker_utterance.extend(val_speaker+[102])
+            speaker_iutterance.extend(val_speaker+[102])
+            listener_iutterance.extend([0 for _ in range(len(val_speaker))]+[102])
+#
+        else:
+            listener_utterance.extend(val_speaker+[102])
+            listener_iutterance.extend(val_speaker+[102])
+            speaker_iutterance.extend([0 for _ in range(len(val_speaker))]+[102])
 
-            total_utterance.extend(val_speaker+[102])
-            total_utterance_list.append(val_speaker+[102])
+        total_utterance.extend(val_speaker+[102])
+        total_utterance_list.append(val_speaker+[102])
 
 
-        turn_data = [[101]+a+b for a, b in zip(total_utterance_list[::2],total_utterance_list[1::2])] # turnwise data, [[s1],[l1],[s2],[l2],..] --> [[s1;l1],[s2;l2],..]
+    turn_data = [[101]+a+b for a, b in zip(total_utterance_list[::2],total_utterance_list[1::2])] # turnwise data, [[s1],[l1],[s2],[l2],..] --> [[s1;l1],[s2;l2],..]
+    if len(total_utterance_list)%2 == 1: # the last speaker utterance has no listener reply, but is still a turn
+        turn_data.append([101]+total_utterance_list[-1])
 
-        total_utterance_list = [[101]+i for i in total_utterance_list] #appending 101 to every utterance start
+    total_utterance_list = [[101]+i for i in total_utterance_list] #appending 101 to every utterance start
 
-        arousal_vec = get_arousal_vec(tokenizer,total_utterance)
-        valence_vec = get_valence_vec(tokenizer,total_utterance)
-        dom_vec = get_dom_vec(tokenizer,total_utterance)
+    total_utterance = truncate_sequence(total_utterance,max_len,truncation) ## the model input, see collate_fn
 
+    [arousal_vec],[valence_vec],[dom_vec] = get_vad_batch(tokenizer,[total_utterance])
+    turn_vad = get_vad_batch(tokenizer,turn_data) ## for the turn-level models
+
+    return total_utterance_list,turn_data,speaker_iutterance,listener_iutterance,speaker_utterance,listener_utterance,total_utterance,arousal_vec,valence_vec,dom_vec,turn_vad
+
+def tokenize_conversation_shard(shard,max_len=None,truncation="head"):
+    return [tokenize_conversation(worker_tokenizer,val_utterance,max_len,truncation) for val_utterance in shard]
+
+
+def tokenize_data(processed_data,tokenizer_type="bert-base-uncased",pool=None,max_len=None,truncation="head"):
+
+    if pool is None:
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_type)
+        tokenized_conversations = [tokenize_conversation(tokenizer,val_utterance,max_len,truncation) for val_utterance in processed_data["utterance_data_list"]]
+    else:
+        tokenized_conversations = run_sharded(functools.partial(tokenize_conversation_shard,max_len=max_len,truncation=truncation),processed_data["utterance_data_list"],pool)
+
+    tokenized_inter_speaker, tokenized_inter_listener = [],[]
+    tokenized_total_data,tokenized_speaker,tokenized_listener = [],[],[]
+    tokenized_list_data,tokenized_turn_data = [],[]
+    arousal_data,valence_data,dom_data = [],[],[]
+    turn_arousal_data,turn_valence_data,turn_dom_data = [],[],[]
+
+    for total_utterance_list,turn_data,speaker_iutterance,listener_iutterance,speaker_utterance,listener_utterance,total_utterance,arousal_vec,valence_vec,dom_vec,turn_vad in tokenized_conversations:
 
         tokenized_inter_speaker.append(speaker_iutterance)
         tokenized_inter_listener.append(listener_iutterance)
@@ -186,19 +228,42 @@ def tokenize_data(processed_data,tokenizer_type="bert-base-uncased"):
         valence_data.append(valence_vec)
         dom_data.append(dom_vec)
 
+        turn_arousal_data.append(turn_vad[0])
+        turn_valence_data.append(turn_vad[1])
+        turn_dom_data.append(turn_vad[2])
+
 
     assert len(tokenized_list_data) == len(tokenized_turn_data) ==len(tokenized_inter_speaker) == len(tokenized_inter_listener) == len(tokenized_total_data) ==len(tokenized_listener) ==len(tokenized_speaker) == len(processed_data["emotion"]) == len(tokenized_total_data) == len(arousal_data) == len(valence_data) == len(dom_data)
 
-    save_data = {"utterance_data_list":tokenized_list_data,"utterance_data":tokenized_total_data,"utterance_data_str":processed_data["utterance_data_list"],"speaker_idata":tokenized_inter_speaker,"listener_idata":tokenized_inter_listener,"speaker_data":tokenized_speaker,"listener_data":tokenized_listener,"turn_data":tokenized_turn_data,"arousal_data":arousal_data,"valence_data":valence_data,"dom_data":dom_data,"emotion":processed_data["emotion"]}
+    save_data = {"utterance_data_list":tokenized_list_data,"utterance_data":tokenized_total_data,"utterance_data_str":processed_data["utterance_data_list"],"speaker_idata":tokenized_inter_speaker,"listener_idata":tokenized_inter_listener,"speaker_data":tokenized_speaker,"listener_data":tokenized_listener,"turn_data":tokenized_turn_data,"arousal_data":arousal_data,"valence_data":valence_data,"dom_data":dom_data,"turn_arousal_data":turn_arousal_data,"turn_valence_data":turn_valence_data,"turn_dom_data":turn_dom_data,"emotion":processed_data["emotion"]}
 
     return save_data
 
 
-def go_emotions_preprocess(tokenizer_type="bert-base-uncased"):
+def tokenize_cause(tokenizer,cause,max_len=None,truncation="head"):
+    '''
+    Tokenizes a list of tweets/comments and extracts their lexicon vectors, one (tokens,arousal,valence,dom) tuple per item
+    '''
+    tokenized_cause =tokenizer.batch_encode_plus(cause).input_ids
+    tokenized_cause = [truncate_sequence(tokens,max_len,truncation) for tokens in tokenized_cause]
+
+    arousal_vec,valence_vec,dom_vec = get_vad_batch(tokenizer,tokenized_cause)
+    tokenized_items = list(zip(tokenized_cause,arousal_vec,valence_vec,dom_vec))
+
+    return tokenized_items
+
+def tokenize_cause_shard(shard,max_len=None,truncation="head"):
+    return tokenize_cause(worker_tokenizer,shard,max_len,truncation)
+
+
+def go_emotions_preprocess(tokenizer_type="bert-base-uncased",pool=None,data_format="pickle",max_len=None,truncation="head"):
         data_dict = {}
         data_home = "./.data/goemotions/"
         nlabel = 27
 
+        if pool is None:
+            tokenizer = AutoTokenizer.from_pretrained(tokenizer_type)
+
         for datatype in ["train","valid","test"]:
             datafile = data_home + datatype + ".tsv"
             ## cause => tweet, changed for uniformity sake
@@ -211,8 +276,12 @@ def go_emotions_preprocess(tokenizer_type="bert-base-uncased"):
                 cause.append(data["cause"][i])
 
             print("Tokenizing data")
-            tokenizer = AutoTokenizer.from_pretrained(tokenizer_type)
-            tokenized_cause =tokenizer.batch_encode_plus(cause).input_ids
+            if pool is None:
+                tokenized_items = tokenize_cause(tokenizer,cause,max_len,truncation)
+            else:
+                tokenized_items = run_sharded(functools.partial(tokenize_cause_shard,max_len=max_len,truncation=truncation),cause,pool)
+
+            tokenized_cause = [item[0] for item in tokenized_items]
 
             processed_data = {}
             maximum_utterance = max([len(i) for i in tokenized_cause])
@@ -226,11 +295,9 @@ def go_emotions_preprocess(tokenizer_type="bert-base-uncased"):
             processed_data["emotion"] = emotion
             processed_data["cause"] = cause
 
-            arousal_vec,valence_vec,dom_vec = [],[],[]
-            for cause_i in tokenized_cause:
-                arousal_vec.append(get_arousal_vec(tokenizer,cause_i))
-                valence_vec.append(get_valence_vec(tokenizer,cause_i))
-                dom_vec.append(get_dom_vec(tokenizer,cause_i))
+            arousal_vec = [item[1] for item in tokenized_items]
+            valence_vec = [item[2] for item in tokenized_items]
+            dom_vec = [item[3] for item in tokenized_items]
 
 
             processed_data["arousal_data"] = arousal_vec
@@ -242,13 +309,21 @@ def go_emotions_preprocess(tokenizer_type="bert-base-uncased"):
 
             print(len(emotion),len(tokenized_cause),len(arousal_vec),len(valence_vec),len(dom_vec))
         if tokenizer_type == "bert-base-uncased":
-            with open("./.preprocessed_data/goemotions_preprocessed_bert.pkl", 'wb') as f:
-                pickle.dump(data_dict, f)
-            f.close()
+            if data_format == "columnar":
+                for datatype,processed_data in data_dict.items():
+                    save_columnar("./.preprocessed_data/goemotions_columnar/"+datatype,processed_data["tokenized_cause"],processed_data["arousal_data"],processed_data["valence_data"],processed_data["dom_data"],processed_data["emotion"],processed_data["cause"])
+            else:
+                with open("./.preprocessed_data/goemotions_preprocessed_bert.pkl", 'wb') as f:
+                    pickle.dump(data_dict, f)
+                f.close()
 
-def sem_eval_preprocess(tokenizer_type):
+def sem_eval_preprocess(tokenizer_type,pool=None,data_format="pickle",max_len=None,truncation="head"):
 
     data_dict = {}
+
+    if pool is None:
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_type)
+
     for datatype in ["train","valid","test"]:
 
         with open("./.data/sem_eval/"+datatype+".txt", 'r') as fd:
@@ -271,8 +346,12 @@ def sem_eval_preprocess(tokenizer_type):
             emotion.append(y[i])
 
         print("Tokenizing data")
-        tokenizer = AutoTokenizer.from_pretrained(tokenizer_type)
-        tokenized_cause =tokenizer.batch_encode_plus(cause).input_ids
+        if pool is None:
+            tokenized_items = tokenize_cause(tokenizer,cause,max_len,truncation)
+        else:
+            tokenized_items = run_sharded(functools.partial(tokenize_cause_shard,max_len=max_len,truncation=truncation),cause,pool)
+
+        tokenized_cause = [item[0] for item in tokenized_items]
 
         processed_data = {}
         maximum_utterance = max([len(i) for i in tokenized_cause])
@@ -286,11 +365,9 @@ def sem_eval_preprocess(tokenizer_type):
         processed_data["emotion"] = emotion
         processed_data["cause"] = cause
 
-        arousal_vec,valence_vec,dom_vec = [],[],[]
-        for cause_i in tokenized_cause:
-            arousal_vec.append(get_arousal_vec(tokenizer,cause_i))
-            valence_vec.append(get_valence_vec(tokenizer,cause_i))
-            dom_vec.append(get_dom_vec(tokenizer,cause_i))
+        arousal_vec = [item[1] for item in tokenized_items]
+        valence_vec = [item[2] for item in tokenized_items]
+        dom_vec = [item[3] for item in tokenized_items]
 
 
         processed_data["arousal_data"] = arousal_vec
@@ -303,9 +380,12 @@ def sem_eval_preprocess(tokenizer_type):
         print(len(emotion),len(tokenized_cause),len(arousal_vec),len(valence_vec),len(dom_vec))
 
         if tokenizer_type == "bert-base-uncased":
-            with open("./.preprocessed_data/semeval_preprocessed_bert.pkl", 'wb') as f:
-                pickle.dump(data_dict, f)
-            f.close()
+            if data_format == "columnar":
+                save_columnar("./.preprocessed_data/semeval_columnar/"+datatype,processed_data["tokenized_cause"],processed_data["arousal_data"],processed_data["valence_data"],processed_data["dom_data"],processed_data["emotion"],processed_data["cause"])
+            else:
+                with open("./.preprocessed_data/semeval_preprocessed_bert.pkl", 'wb') as f:
+                    pickle.dump(data_dict, f)
+                f.close()
 
 if __name__ == '__main__':
 
@@ -315,31 +395,49 @@ if __name__ == '__main__':
                    help='Enter tokenizer type')
     parser.add_argument('-d', default="goemotions",type=str,
                    help='Enter dataset')
+    parser.add_argument('-w','--workers', default=1,type=int,
+                   help='Enter number of worker processes for tokenization and lexicon extraction')
+    parser.add_argument('-f','--format', default="pickle",type=str,
+                   help='Enter output format, pickle or columnar (memory-mapped arrays)')
+    parser.add_argument('-l','--max_len', default=None,type=int,
+                   help='Enter maximum number of tokens per example, no truncation by default')
+    parser.add_argument('--truncation', default="head",type=str,
+                   help='Enter which tokens of longer examples are kept, head, tail or head_tail')
 
     args = parser.parse_args()
     tokenizer_type = args.t
+    pool = get_pool(tokenizer_type,args.workers)
 
     if args.d == "ed":
         train_pdata = data_reader("./.data/raw/empatheticdialogues/","train")
         valid_pdata = data_reader("./.data/raw/empatheticdialogues/","valid")
         test_pdata = data_reader("./.data/raw/empatheticdialogues/","test")
 
-        train_save_data = tokenize_data(train_pdata,tokenizer_type)
-        valid_save_data = tokenize_data(valid_pdata,tokenizer_type)
-        test_save_data = tokenize_data(test_pdata,tokenizer_type)
+        train_save_data = tokenize_data(train_pdata,tokenizer_type,pool,args.max_len,args.truncation)
+        valid_save_data = tokenize_data(valid_pdata,tokenizer_type,pool,args.max_len,args.truncation)
+        test_save_data = tokenize_data(test_pdata,tokenizer_type,pool,args.max_len,args.truncation)
 
         ## used previously during model design
         glove_vocab_size = 0
         glove_word_embeddings = []
 
         if tokenizer_type == "bert-base-uncased":
-            with open('./.preprocessed_data/mid_dataset_preproc.p', "wb") as f:
-                pickle.dump([train_save_data, valid_save_data, test_save_data, glove_vocab_size,glove_word_embeddings], f)
-                print("Saved PICKLE")
+            if args.format == "columnar":
+                for datatype,save_data in [("train",train_save_data),("valid",valid_save_data),("test",test_save_data)]:
+                    save_columnar("./.preprocessed_data/ed_columnar/"+datatype,save_data["utterance_data"],save_data["arousal_data"],save_data["valence_data"],save_data["dom_data"],save_data["emotion"],save_data["utterance_data_str"])
+                print("Saved columnar data")
+            else:
+                with open('./.preprocessed_data/mid_dataset_preproc.p', "wb") as f:
+                    pickle.dump([train_save_data, valid_save_data, test_save_data, glove_vocab_size,glove_word_embeddings], f)
+                    print("Saved PICKLE")
     elif args.d == "goemotions":
-        go_emotions_preprocess(tokenizer_type)
+        go_emotions_preprocess(tokenizer_type,pool,args.format,args.max_len,args.truncation)
     elif args.d == "semeval":
-        sem_eval_preprocess(tokenizer_type)
+        sem_eval_preprocess(tokenizer_type,pool,args.format,args.max_len,args.truncation)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
 
 
@@ -0,0 +1,171 @@
+import os
+import io
+import time
+import json
+import inspect
+import resource
+import tempfile
+import argparse
+import multiprocessing as mp
+from easydict import EasyDict as edict
+
+## torch packages
+import torch
+import torch.nn as nn
+
+## custom
+from select_model_input import load_model
+import dataset
+from eval import eval_model as eval_model_singlelabel
+from eval_multilabel import eval_model as eval_model_multilabel
+
+
+def quantize_model(model):
+    '''
+    Dynamic int8 quantization for CPU inference: weights of every nn.Linear (encoder layers, a/v/d lexicon projections,
+    fc1 and label) and of the word-level BiLSTM are stored in int8, activations are quantized on the fly
+    '''
+    model = model.to("cpu")
+    model.eval()
+
+    return torch.quantization.quantize_dynamic(model,{nn.Linear,nn.LSTM},dtype=torch.qint8)
+
+
+def load_quantized_model(filename):
+    '''
+    Loads a model_best.pth.tar of any select_model architecture as a dynamically quantized cpu model
+    '''
+    model,config = load_model(filename,device="cpu")
+
+    return quantize_model(model),config
+
+
+def get_model_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(),buffer)
+    return buffer.tell()/1e6 # MB
+
+
+def get_peak_memory():
+    ## VmHWM, the peak of this process image. ru_maxrss also counts the process it was forked from, it is kept across exec
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])/1e3 # MB, in kB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3 # MB, ru_maxrss is in KB on linux
+
+def get_resident_memory():
+    with open("/proc/self/statm") as f: ## linux
+        return int(f.read().split()[1])*resource.getpagesize()/1e6 # MB
+
+
+def evaluate(model,data_iter,loss_fn,log_dict,save_home):
+
+    start_time = time.time()
+    if log_dict.param.dataset == "ed":
+        loss,acc,f1,w_f1,top3_acc = eval_model_singlelabel(model,data_iter,loss_fn,log_dict)
+        result = {"loss":loss,"acc":acc,"f1":f1,"weighted_f1":w_f1,"top3_acc":top3_acc}
+    else:
+        loss,result = eval_model_multilabel(model,data_iter,loss_fn,log_dict,save_home,thresholds=log_dict.param.get("thresholds"))
+        result = {"loss":loss,"precision":result["precision"],"recall":result["recall"],"f1":result["f1"]}
+    total_time = time.time()-start_time
+
+    n_examples = len(data_iter.dataset)
+    result["latency_ms"] = 1000*total_time/len(data_iter) # per eval batch
+    result["examples_per_sec"] = n_examples/total_time
+
+    return result
+
+
+def run_model(filename,save_home,splits,eval_batch_size=None,threads=None):
+    '''
+    Loads a whole model saved by save_model and evaluates it on the splits. Run in a process of its own (see measure),
+    so the memory is that of this model alone
+    '''
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+    ## a pickled module, newer torch loads weights only by default
+    kwargs = {"weights_only":False} if "weights_only" in inspect.signature(torch.load).parameters else {}
+    saved = torch.load(filename,map_location="cpu",**kwargs)
+    model,config = saved["model"],edict(saved["param"])
+    ## checkpoints from older configs may miss some of these keys
+    config.confusion,config.per_class = False,False
+    config.eval_batch_size = eval_batch_size or config.get("eval_batch_size",1)
+    log_dict = edict({"param":config})
+
+    loss_fn = nn.CrossEntropyLoss() if config.dataset == "ed" else nn.BCEWithLogitsLoss()
+    _, valid_iter, test_iter = dataset.get_dataloader(config.batch_size,config.dataset,config.arch_name,config.get("data_format","pickle"),None,config.eval_batch_size,config.get("max_len",512),config.get("truncation","head"),config.get("packing",False))
+    data_iters = {"valid":valid_iter,"test":test_iter}
+
+    result = {"model_size_mb":get_model_size(model),"threads":torch.get_num_threads()}
+    for split in splits:
+        result[split] = evaluate(model,data_iters[split],loss_fn,log_dict,save_home)
+    result["peak_memory_mb"] = get_peak_memory()
+    result["resident_memory_mb"] = get_resident_memory()
+
+    return result
+
+
+def save_model(model,config,filename):
+    torch.save({"model":model,"param":dict(config)},filename)
+
+def measure(filename,save_home,splits,eval_batch_size=None,threads=None):
+    '''
+    run_model in a new spawned process, a forked one would start from the memory of this process
+    '''
+    with mp.get_context("spawn").Pool(1) as pool:
+        return pool.apply(run_model,(filename,save_home,splits,eval_batch_size,threads))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compare a dynamically int8-quantized model with the float model on cpu')
+
+    parser.add_argument('-c', type=str, required=True,
+                   help='Enter the path of model_best.pth.tar')
+    parser.add_argument('-s', default="valid,test",type=str,
+                   help='Enter the comma separated splits to evaluate')
+    parser.add_argument('-b', default=None,type=int,
+                   help='Enter eval batch size, defaults to the one in the checkpoint')
+    parser.add_argument('--threads', default=None,type=int,
+                   help='Enter number of cpu threads for inference')
+
+    args = parser.parse_args()
+    save_home = os.path.dirname(args.c)
+    splits = args.s.split(",")
+
+    ## both models are saved whole and measured in a process each, which loads the data and only its own model
+    model,config = load_model(args.c,device="cpu")
+    with tempfile.TemporaryDirectory() as tmp_home:
+        save_model(model,config,tmp_home+"/float.pt")
+        save_model(quantize_model(model),config,tmp_home+"/quantized.pt")
+        del model
+
+        float_report = measure(tmp_home+"/float.pt",save_home,splits,args.b,args.threads)
+        quantized_report = measure(tmp_home+"/quantized.pt",save_home,splits,args.b,args.threads)
+
+    report = {"float_model_size_mb":float_report["model_size_mb"],"quantized_model_size_mb":quantized_report["model_size_mb"],"threads":float_report["threads"]}
+
+    for split in splits:
+
+        float_result = float_report[split]
+        quantized_result = quantized_report[split]
+
+        report[split] = {"float":float_result,"quantized":quantized_result,
+                         "delta":{k:quantized_result[k]-float_result[k] for k in float_result},
+                         "speedup":quantized_result["examples_per_sec"]/float_result["examples_per_sec"]}
+
+        print(f'{split}: F1 {float_result["f1"]:.4f} -> {quantized_result["f1"]:.4f}, Throughput {float_result["examples_per_sec"]:.2f} -> {quantized_result["examples_per_sec"]:.2f} examples/sec ({report[split]["speedup"]:.2f}x)')
+
+    ## peak resident memory of each process, the data loaded by both is included in each
+    report["float_peak_memory_mb"] = float_report["peak_memory_mb"]
+    report["quantized_peak_memory_mb"] = quantized_report["peak_memory_mb"]
+    report["float_resident_memory_mb"] = float_report["resident_memory_mb"]
+    report["quantized_resident_memory_mb"] = quantized_report["resident_memory_mb"]
+    print(f'Model size: {report["float_model_size_mb"]:.1f} MB -> {report["quantized_model_size_mb"]:.1f} MB, Peak memory: {report["float_peak_memory_mb"]:.1f} MB -> {report["quantized_peak_memory_mb"]:.1f} MB, Resident memory after evaluation: {report["float_resident_memory_mb"]:.1f} MB -> {report["quantized_resident_memory_mb"]:.1f} MB')
+
+    with open(os.path.join(save_home,"quantization_report.json"), 'w') as fp:
+        json.dump(report, fp,indent=4)
+    fp.close()
@@ -1,36 +1,85 @@
 import torch
+from easydict import EasyDict as edict
 
 ## custom-
-from models.model import KEA_ELECTRA, KEA_Electra_Word_level,KEA_Bert_Word_level,KEA_BERT
+from models.model import KEA_ELECTRA, KEA_Electra_Word_level,KEA_Bert_Word_level,KEA_BERT,KEA_Electra_Turn_level,KEA_Bert_Turn_level,upgrade_state_dict
 
 
 ## config here is log_dict.param
+def get_device(config):
+
+    device = config.get("device")
+    if device is None: ## cuda when available, otherwise cpu
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    return torch.device(device)
+
+
 def select_model(config):
 
     batch_size = config.batch_size
     hidden_size = config.hidden_size
     output_size = config.output_size
     arch_name = config.arch_name
+    grad_checkpoint = config.get("grad_checkpoint",False)
+    max_len = config.get("max_len",512) # checkpoints from before max_len was configurable
 
     if arch_name == "kea_electra":
-        model = KEA_ELECTRA(batch_size,output_size,hidden_size)
+        model = KEA_ELECTRA(batch_size,output_size,hidden_size,grad_checkpoint,max_len)
     if arch_name == "kea_bert":
-        model = KEA_BERT(batch_size,output_size,hidden_size)
+        model = KEA_BERT(batch_size,output_size,hidden_size,grad_checkpoint,max_len)
     if arch_name == "kea_electra_word":
-        model = KEA_Electra_Word_level(batch_size,output_size,hidden_size)
+        model = KEA_Electra_Word_level(batch_size,output_size,hidden_size,grad_checkpoint)
     if arch_name == "kea_bert_word":
-        model = KEA_Bert_Word_level(batch_size,output_size,hidden_size)
+        model = KEA_Bert_Word_level(batch_size,output_size,hidden_size,grad_checkpoint)
+    if arch_name == "kea_electra_turn":
+        model = KEA_Electra_Turn_level(batch_size,output_size,hidden_size,grad_checkpoint,max_len)
+    if arch_name == "kea_bert_turn":
+        model = KEA_Bert_Turn_level(batch_size,output_size,hidden_size,grad_checkpoint,max_len)
+
+    if config.get("freeze"): ## encoder weights stay pretrained, only the KEA head is trained
+        for p in model.encoder.parameters():
+            p.requires_grad = False
+
+    model = model.to(get_device(config))
     return model
 
 
+def load_model(filename,device=None,map_location="cpu"):
+    '''
+    Rebuilds the model saved in a model_best.pth.tar checkpoint (including checkpoints from before the encoder-only
+    layout) on device (None picks cuda when available) and returns it with the param dict it was trained with, plus
+    the tuned thresholds of multilabel models
+    '''
+    checkpoint = torch.load(filename,map_location=map_location)
+
+    config = edict(checkpoint["param"])
+    config.device = device
+    config.thresholds = checkpoint.get("thresholds") ## per-class thresholds of multilabel models, None for a fixed threshold
+    model = select_model(config)
+    model.load_state_dict(upgrade_state_dict(checkpoint["state_dict"]))
+
+    return model,config
+
+
 
 def select_input(batch,config):
 
     dataset = config.dataset
     arch_name = config.arch_name
 
-    text = [batch["utterance_data"],batch["arousal_data"],batch["valence_data"],batch["dom_data"]]
-    attn = batch["utterance_data_attn_mask"]
+    if "turn_data" in batch: ## turn-level models, one row per turn and the turns of every conversation
+        text = [batch["turn_data"],batch["turn_arousal_data"],batch["turn_valence_data"],batch["turn_dom_data"],batch["turn_index"]]
+        attn = batch["turn_data_attn_mask"]
+    elif "packed_data" in batch: ## several examples per row, the models unpack them after the encoder
+        text = [batch["packed_data"],batch["arousal_data"],batch["valence_data"],batch["dom_data"],batch["packed_position_ids"],batch["packed_index"]]
+        attn = batch["packed_attn_mask"]
+    else:
+        if "hidden_data" in batch: ## frozen encoder, the models take the cached hidden states instead of the token ids
+            text = [batch["hidden_data"],batch["arousal_data"],batch["valence_data"],batch["dom_data"]]
+        else:
+            text = [batch["utterance_data"],batch["arousal_data"],batch["valence_data"],batch["dom_data"]]
+        attn = batch["utterance_data_attn_mask"]
 
     if dataset == "ed": ##single-label, the output label is numerical
 
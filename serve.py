@@ -0,0 +1,255 @@
+## HTTP inference server batching concurrent requests into one forward of predict.EmotionClassifier, see README
+import time
+import json
+import asyncio
+import argparse
+import collections
+import concurrent.futures
+
+## custom
+from predict import EmotionClassifier
+
+
+class LatencyHistogram:
+
+    '''
+    Request latencies in fixed millisecond buckets (the last one is everything above), plus the most recent ones for
+    percentiles
+    '''
+
+    buckets = [5,10,25,50,100,250,500,1000,2500,5000,10000]
+
+    def __init__(self,window=10000):
+        self.counts = [0]*(len(self.buckets)+1)
+        self.recent = collections.deque(maxlen=window)
+
+    def add(self,latency_ms):
+        i = 0
+        while i < len(self.buckets) and latency_ms > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.recent.append(latency_ms)
+
+    def percentile(self,q):
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered)-1,int(q/100*len(ordered)))]
+
+    def summary(self):
+        labels = ["<="+str(b) for b in self.buckets]+[">"+str(self.buckets[-1])]
+        return {"buckets_ms":dict(zip(labels,self.counts)),"p50_ms":self.percentile(50),"p90_ms":self.percentile(90),"p99_ms":self.percentile(99)}
+
+
+class Request:
+
+    def __init__(self,inputs,future):
+        self.inputs = inputs
+        self.future = future
+        self.arrival = time.perf_counter()
+
+
+class MicroBatcher:
+
+    '''
+    Collects the inputs of concurrent requests into batches of at most max_batch_size inputs. A batch is run as soon
+    as it is full, or max_wait_ms after its first request arrived, with one predict_fn call on a worker thread so the
+    event loop keeps accepting requests during the forward. A request larger than max_batch_size is a batch of its own
+    '''
+
+    def __init__(self,predict_fn,max_batch_size=32,max_wait_ms=10):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms/1000
+        self.queue = asyncio.Queue()
+        self.carry = None ## a request that did not fit the previous batch
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.latency = LatencyHistogram()
+        self.batch_sizes = collections.Counter()
+        self.stats = {"requests":0,"inputs":0,"batches":0,"errors":0,"forward_time":0.0,"in_flight":0}
+        self.start_time = time.perf_counter()
+
+    async def predict(self,inputs):
+        future = asyncio.get_event_loop().create_future()
+        self.queue.put_nowait(Request(inputs,future))
+        return await future
+
+    async def next_request(self,timeout=None):
+        if self.carry is not None:
+            request,self.carry = self.carry,None
+            return request
+        if timeout is None:
+            return await self.queue.get()
+        if timeout <= 0: ## past the deadline, only requests already queued (e.g. during the previous forward) join
+            return self.queue.get_nowait()
+        return await asyncio.wait_for(self.queue.get(),timeout)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            request = await self.next_request()
+            batch,size = [request],len(request.inputs)
+            deadline = request.arrival+self.max_wait
+
+            while size < self.max_batch_size:
+                try:
+                    request = await self.next_request(deadline-time.perf_counter())
+                except (asyncio.TimeoutError,asyncio.QueueEmpty):
+                    break
+                if size+len(request.inputs) > self.max_batch_size:
+                    self.carry = request
+                    break
+                batch.append(request)
+                size += len(request.inputs)
+
+            inputs = [x for request in batch for x in request.inputs]
+            self.stats["in_flight"] = len(inputs)
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor,self.predict_fn,inputs)
+            except Exception as e: ## every request of the batch gets the error, the server goes on
+                self.stats["errors"] += len(batch)
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            finally:
+                self.stats["in_flight"] = 0
+
+            end = time.perf_counter()
+            self.stats["forward_time"] += end-start
+            self.stats["batches"] += 1
+            self.stats["requests"] += len(batch)
+            self.stats["inputs"] += len(inputs)
+            self.batch_sizes[len(inputs)] += 1
+
+            i = 0
+            for request in batch:
+                self.latency.add(1000*(end-request.arrival))
+                if not request.future.done(): ## the client may have disconnected
+                    request.future.set_result(results[i:i+len(request.inputs)])
+                i += len(request.inputs)
+
+    def summary(self):
+        uptime = time.perf_counter()-self.start_time
+        summary = dict(self.stats)
+        summary.update({"uptime":uptime,
+                        "queue_depth":self.queue.qsize()+(self.carry is not None),
+                        "queued_inputs":sum(len(r.inputs) for r in self.queue._queue)+(len(self.carry.inputs) if self.carry is not None else 0),
+                        "mean_batch_size":self.stats["inputs"]/max(1,self.stats["batches"]),
+                        "batch_sizes":dict(sorted(self.batch_sizes.items())),
+                        "max_batch_size":self.max_batch_size,"max_wait_ms":1000*self.max_wait,
+                        "inputs_per_sec":self.stats["inputs"]/uptime if uptime > 0 else 0.0,
+                        "latency":self.latency.summary()})
+        return summary
+
+
+def get_inputs(body):
+    '''
+    The inputs of a /predict body, {"inputs": [texts or dialogues]} or {"text": text}
+    '''
+    request = json.loads(body)
+    inputs = request.get("inputs",[request["text"]] if "text" in request else None) if isinstance(request,dict) else None
+    if not isinstance(inputs,list) or not all(isinstance(x,str) or (isinstance(x,list) and x and all(isinstance(u,str) for u in x)) for x in inputs):
+        raise ValueError('expected {"inputs": [texts or lists of utterances]} or {"text": text}')
+    return inputs
+
+
+async def write_response(writer,status,body):
+    body = json.dumps(body).encode()
+    reason = {200:"OK",400:"Bad Request",404:"Not Found",500:"Internal Server Error"}[status]
+    writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode()+body)
+    await writer.drain()
+
+
+def get_handler(batcher):
+    '''
+    A minimal HTTP/1.1 handler with keep-alive: POST /predict and GET /stats
+    '''
+    async def handle(reader,writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method,path,_ = request_line.decode("latin-1").split(" ",2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n",b"\n",b""):
+                        break
+                    key,_,value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length",0)))
+
+                if method == "GET" and path == "/stats":
+                    await write_response(writer,200,batcher.summary())
+                elif method == "POST" and path == "/predict":
+                    try:
+                        inputs = get_inputs(body)
+                    except (ValueError,KeyError) as e:
+                        await write_response(writer,400,{"error":str(e)})
+                    else:
+                        try:
+                            results = await batcher.predict(inputs)
+                        except Exception as e:
+                            await write_response(writer,500,{"error":repr(e)})
+                        else:
+                            await write_response(writer,200,{"results":results})
+                else:
+                    await write_response(writer,404,{"error":"POST /predict or GET /stats"})
+
+                if headers.get("connection","").lower() == "close":
+                    break
+        except (ConnectionError,asyncio.IncompleteReadError,ValueError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(classifier,host,port,max_batch_size,max_wait_ms):
+    batcher = MicroBatcher(classifier.predict,max_batch_size,max_wait_ms)
+    batch_task = asyncio.ensure_future(batcher.run())
+    server = await asyncio.start_server(get_handler(batcher),host,port)
+    print(f"Serving on http://{host}:{port}, max batch size {max_batch_size}, max wait {max_wait_ms} ms")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Serve a trained model over HTTP with dynamic batching')
+
+    parser.add_argument('-c', type=str, required=True,
+                   help='Enter the path of model_best.pth.tar')
+    parser.add_argument('-b', default=32,type=int,
+                   help='Enter maximum number of inputs per forward')
+    parser.add_argument('-w', default=10,type=float,
+                   help='Enter maximum time in ms a request waits for others to join its batch')
+    parser.add_argument('--host', default="127.0.0.1",type=str,
+                   help='Enter host')
+    parser.add_argument('-p','--port', default=8000,type=int,
+                   help='Enter port')
+    parser.add_argument('-t', default="bert-base-uncased",type=str,
+                   help='Enter tokenizer type, the one of preprocess.py')
+    parser.add_argument('-d', default=None,type=str,
+                   help='Enter device, defaults to cuda when available')
+    parser.add_argument('--threads', default=None,type=int,
+                   help='Enter number of cpu threads for inference')
+
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        import torch
+        torch.set_num_threads(args.threads)
+
+    classifier = EmotionClassifier(args.c,args.d,args.b,args.t)
+    try:
+        asyncio.run(serve(classifier,args.host,args.port,args.b,args.w))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,269 @@
+## Hyperparameter sweeps over the param dict of config.py (train.py) or config_multilabel.py (train_mutlilabel.py), see README
+import os
+import time
+import json
+import math
+import random
+import itertools
+import statistics
+import argparse
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from easydict import EasyDict as edict
+
+## torch packages
+import torch
+import torch.nn as nn
+from torch.utils.tensorboard import SummaryWriter
+
+## custom
+from select_model_input import select_model
+import dataset
+import encoder_cache
+
+## data and pretrained models, loaded once by the sweep process and inherited by every trial (see run_sweep)
+shared = {}
+
+## keys that change what get_dataloader reads, every trial uses the data of the base parameters
+data_keys = ["dataset","data_format"]
+## keys that change the pretrained model, one model is built per combination
+model_keys = ["arch_name","hidden_size","output_size","max_len","grad_checkpoint"]
+
+
+def grid_trials(space):
+    '''
+    Every combination of the values of space, {key: [values]}
+    '''
+    keys = list(space)
+    return [dict(zip(keys,values)) for values in itertools.product(*[space[key] for key in keys])]
+
+def random_trials(space,n_trials,seed=0):
+    '''
+    n_trials samples of space, a list of values is sampled uniformly and {"low","high"} (with "log": true for
+    learning rates) from the range
+    '''
+    rng = random.Random(seed)
+    trials = []
+    for _ in range(n_trials):
+        trial = {}
+        for key,values in space.items():
+            if isinstance(values,dict):
+                if values.get("log"):
+                    trial[key] = math.exp(rng.uniform(math.log(values["low"]),math.log(values["high"])))
+                else:
+                    trial[key] = rng.uniform(values["low"],values["high"])
+            else:
+                trial[key] = rng.choice(values)
+        trials.append(trial)
+    return trials
+
+
+class MedianStopping:
+
+    '''
+    Median stopping rule: after min_epochs, a trial stops when its best validation metric so far is below the median
+    of the best metrics the other trials had reached after the same number of epochs. The history is shared between
+    the trial processes
+    '''
+
+    def __init__(self,history,trial_id,min_epochs=1):
+        self.history = history
+        self.trial_id = trial_id
+        self.min_epochs = min_epochs
+        self.stopped = False
+
+    def __call__(self,epoch,metric):
+        metrics = self.history.get(self.trial_id,[])+[metric]
+        self.history[self.trial_id] = metrics ## assigned again, the history is a manager dict
+        if len(metrics) < self.min_epochs:
+            return False
+
+        others = [max(other[:len(metrics)]) for trial_id,other in self.history.items() if trial_id != self.trial_id and len(other) >= len(metrics)]
+        self.stopped = len(others) > 0 and max(metrics) < statistics.median(others)
+        return self.stopped
+
+
+def get_model_key(param):
+    return tuple(param.get(key) for key in model_keys)
+
+
+def run_trial(trial_id,trial,history):
+    '''
+    Trains one trial with train_model of train.py or train_mutlilabel.py and returns its row of the results table
+    '''
+    param = edict(dict(shared["param"],**trial))
+    multilabel = shared["multilabel"]
+
+    np.random.seed(0)
+    random.seed(0)
+    torch.manual_seed(0)
+    torch.cuda.manual_seed(0)
+    torch.cuda.manual_seed_all(0)
+
+    ## the trial runs in a fresh fork of the sweep process, its copies of the data and model are its own
+    model = shared["models"][get_model_key(param)].to("cpu")
+    if param.freeze: ## train the head on the encoder cache built by the sweep process
+        for p in model.encoder.parameters():
+            p.requires_grad = False
+        data = shared["cached_data"][(param.arch_name,param.max_len,param.truncation)]
+        data = dataset.rebuild_dataloader(data,param.batch_size,param.arch_name,param.max_tokens,param.eval_batch_size,param.max_len,param.truncation)
+    else:
+        data = dataset.rebuild_dataloader(shared["data"],param.batch_size,param.arch_name,param.max_tokens,param.eval_batch_size,param.max_len,param.truncation,param.get("packing",False))
+
+    if multilabel:
+        from train_mutlilabel import train_model
+        loss_fn = nn.BCEWithLogitsLoss()
+    else:
+        from train import train_model
+        loss_fn = nn.CrossEntropyLoss()
+
+    optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()),lr=param.learning_rate)
+    lr_scheduler = None
+    if param.step_size != None:
+        steps_per_epoch = math.ceil(len(data[0])/param.get("accumulation_steps",1))
+        lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer,param.step_size*steps_per_epoch, gamma=0.5)
+
+    save_home = shared["sweep_home"]+"/trial_"+str(trial_id)
+    writer = SummaryWriter(shared["runs_home"]+"/trial_"+str(trial_id))
+    should_stop = MedianStopping(history,trial_id,shared["min_epochs"])
+
+    row = {"trial":trial_id}
+    row.update(trial)
+    log_dict = edict({"param":param})
+    try:
+        train_model(log_dict,data,model,loss_fn,optimizer,lr_scheduler,writer,save_home,should_stop=should_stop)
+    except Exception as e: ## the other trials go on, the error is kept in the table
+        row["error"] = repr(e)
+
+    epochs = len(history.get(trial_id,[]))
+    if multilabel:
+        row["valid_f1"] = log_dict.get("valid_result",{}).get("f1")
+        row["test_f1"] = log_dict.get("test_result",{}).get("f1")
+    else:
+        row["valid_acc"] = log_dict.get("valid_acc")
+        row["test_acc"] = log_dict.get("test_acc")
+        row["test_f1_score"] = log_dict.get("test_f1_score")
+    row["best_epoch"] = log_dict.get("epoch")
+    row["epochs"] = epochs
+    row["stopped"] = should_stop.stopped
+    row["save_home"] = save_home
+
+    writer.close()
+    return row
+
+
+def run_trial_args(args):
+    return run_trial(*args)
+
+def init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def run_sweep(param,trials,multilabel,n_workers,sweep_home,runs_home,min_epochs=1):
+    '''
+    Loads the data and the pretrained models once, then trains the trials in n_workers processes forked from this one
+    and returns the results table, best validation metric first
+    '''
+    param = edict(param)
+    for trial in trials:
+        for key in trial:
+            if key not in param:
+                raise ValueError(f"{key} is not a key of the param dict")
+            if key in data_keys and trial[key] != param[key]:
+                raise ValueError(f"{key} cannot be swept, the data is loaded once")
+
+    np.random.seed(0)
+    random.seed(0)
+    torch.manual_seed(0)
+
+    print('Loading dataset')
+    start_time = time.time()
+    shared["data"] = dataset.get_dataloader(param.batch_size,param.dataset,param.arch_name,param.data_format,param.max_tokens,param.eval_batch_size,param.max_len,param.truncation,param.get("packing",False))
+    print('Finished loading. Time taken:{:06.3f} sec'.format(time.time()-start_time))
+
+    ## built on cpu, cuda cannot be initialised before forking. Every model starts from the same seed, as in train.py
+    shared["models"] = {}
+    for trial in trials:
+        trial_param = edict(dict(param,**trial))
+        trial_param.update({"freeze":False,"device":"cpu"})
+        key = get_model_key(trial_param)
+        if key not in shared["models"]:
+            torch.manual_seed(0)
+            shared["models"][key] = select_model(trial_param)
+
+    ## frozen-encoder trials share the encoder cache of their architecture, max_len and truncation
+    shared["cached_data"] = {}
+    for trial in trials:
+        trial_param = edict(dict(param,**trial))
+        trial_param.device = "cpu"
+        key = (trial_param.arch_name,trial_param.max_len,trial_param.truncation)
+        if trial_param.freeze and key not in shared["cached_data"]:
+            shared["cached_data"][key] = encoder_cache.get_cached_dataloader(shared["models"][get_model_key(trial_param)],shared["data"],trial_param)
+
+    shared.update({"param":dict(param),"multilabel":multilabel,"sweep_home":sweep_home,"runs_home":runs_home,"min_epochs":min_epochs})
+
+    ## fork, the trials inherit the loaded data and models copy-on-write. A new process per trial, so memory is returned
+    ctx = mp.get_context("fork")
+    manager = ctx.Manager()
+    history = manager.dict() ## validation metric per epoch of every trial, for MedianStopping
+    num_threads = max(1,(os.cpu_count() or 1)//n_workers)
+    with ctx.Pool(n_workers,initializer=init_worker,initargs=(num_threads,),maxtasksperchild=1) as pool:
+        rows = list(pool.imap_unordered(run_trial_args,[(trial_id,trial,history) for trial_id,trial in enumerate(trials)]))
+    manager.shutdown()
+
+    results = pd.DataFrame(rows)
+    metric = "valid_f1" if multilabel else "valid_acc"
+    return results.sort_values(metric,ascending=False,na_position="last").reset_index(drop=True)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Grid or random search over the parameters of config.py or config_multilabel.py')
+
+    parser.add_argument('-s', required=True,type=str,
+                   help='Enter the search space as json or the path of a json file, e.g. {"learning_rate":[1e-5,3e-5],"batch_size":[8,16]}')
+    parser.add_argument('-m', default="grid",type=str,
+                   help='Enter grid or random')
+    parser.add_argument('-n', default=10,type=int,
+                   help='Enter number of trials for random search')
+    parser.add_argument('-w', default=2,type=int,
+                   help='Enter number of trials trained at the same time')
+    parser.add_argument('-e', default=1,type=int,
+                   help='Enter number of epochs before a trial below the median can be stopped')
+    parser.add_argument('--seed', default=0,type=int,
+                   help='Enter seed of the random search')
+    parser.add_argument('--multilabel', action='store_true',
+                   help='Sweep train_mutlilabel.py and config_multilabel.py instead of train.py and config.py')
+
+    args = parser.parse_args()
+
+    if args.multilabel:
+        import config_multilabel as train_config
+    else:
+        import config as train_config
+
+    if os.path.exists(args.s):
+        with open(args.s) as f:
+            space = json.load(f)
+    else:
+        space = json.loads(args.s)
+
+    if args.m == "grid":
+        trials = grid_trials(space)
+    elif args.m == "random":
+        trials = random_trials(space,args.n,args.seed)
+    else:
+        raise ValueError("-m is grid or random")
+
+    sweep_time = time.strftime("%Y_%m_%d_%H_%M_%S", time.localtime())
+    sweep_home = "./save/"+train_config.param["dataset"]+"/sweeps/"+sweep_time
+    runs_home = "./runs/sweeps/"+sweep_time
+    os.makedirs(sweep_home,exist_ok=True)
+
+    results = run_sweep(train_config.param,trials,args.multilabel,args.w,sweep_home,runs_home,args.e)
+
+    results.to_csv(sweep_home+"/results.csv",index=False)
+    with pd.option_context("display.max_columns",None,"display.width",200):
+        print(results)
+    print("Results saved to",sweep_home+"/results.csv")
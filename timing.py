@@ -0,0 +1,93 @@
+## Per-step time breakdown of the training loop, see train_epoch
+import time
+
+## torch packages
+import torch
+
+
+## in the order of a training step
+phases = ["data","transfer","forward","loss","backward","clip","optimizer","other"]
+
+
+def count_tokens(batch):
+    '''
+    Non-padding tokens of a collated batch, for tokens/sec
+    '''
+    if "turn_data" in batch:
+        return int(batch["turn_data_attn_mask"].sum())
+    return int(batch["utterance_data_attn_mask"].sum())
+
+
+class StepTimer:
+
+    '''
+    Accumulates the time of every phase of the training steps, lap(phase) adds the time since the previous lap. On
+    cuda the device is synchronised at every lap, so that kernels are counted in the phase that launched them
+    '''
+
+    def __init__(self,device):
+        self.sync = torch.device(device).type == "cuda"
+        self.device = device
+        self.totals = self.new_totals()
+        self.window = self.new_totals()
+        self.last = None
+
+    def new_totals(self):
+        totals = dict.fromkeys(phases,0.0)
+        totals.update({"steps":0,"samples":0,"tokens":0})
+        return totals
+
+    def start(self):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        self.last = time.perf_counter()
+
+    def lap(self,phase):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        now = time.perf_counter()
+        for totals in [self.totals,self.window]:
+            totals[phase] += now-self.last
+        self.last = now
+
+    def count(self,samples,tokens):
+        '''
+        Called once per batch
+        '''
+        for totals in [self.totals,self.window]:
+            totals["steps"] += 1
+            totals["samples"] += samples
+            totals["tokens"] += tokens
+
+    @staticmethod
+    def summarise(totals):
+        total_time = sum(totals[phase] for phase in phases)
+        summary = {"batches":totals["steps"],"time":total_time}
+        for phase in phases:
+            summary[phase+"_ms"] = 1000*totals[phase]/max(1,totals["steps"]) ## per batch
+            summary[phase+"_fraction"] = totals[phase]/total_time if total_time > 0 else 0.0
+        summary["samples_per_sec"] = totals["samples"]/total_time if total_time > 0 else 0.0
+        summary["tokens_per_sec"] = totals["tokens"]/total_time if total_time > 0 else 0.0
+        return summary
+
+    def summary(self):
+        return self.summarise(self.totals)
+
+    def report(self):
+        '''
+        One line with the share of every phase and the throughput since the previous report
+        '''
+        summary = self.summarise(self.window)
+        self.window = self.new_totals()
+        shares = ", ".join(f'{phase} {100*summary[phase+"_fraction"]:.0f}%' for phase in phases)
+        return f'Time taken: {summary["time"]/60: .2f} min, {shares}, {summary["samples_per_sec"]:.1f} samples/s, {summary["tokens_per_sec"]:.0f} tokens/s'
+
+
+def add_scalars(writer,summary,epoch):
+    '''
+    The per batch time of every phase and the throughput of an epoch in tensorboard
+    '''
+    for phase in phases:
+        writer.add_scalar('Time/'+phase+'_ms',summary[phase+"_ms"],epoch)
+    writer.add_scalar('Throughput/samples_per_sec',summary["samples_per_sec"],epoch)
+    writer.add_scalar('Throughput/tokens_per_sec',summary["tokens_per_sec"],epoch)
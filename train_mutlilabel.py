@@ -6,6 +6,8 @@ import json
 import random
 import time
 import argparse
+import math
+from contextlib import nullcontext
 import numpy as np
 
 ## torch packages
@@ -21,93 +23,175 @@ import matplotlib.pyplot as plt
 
 ## custom
 from eval_multilabel import eval_model
-from select_model_input import select_model,select_input
+from select_model_input import select_model,select_input,get_device
 import dataset
+import encoder_cache
 import config_multilabel as train_config
 from label_dict import ed_emo_dict
-from utils import save_checkpoint,clip_gradient
+from distributed import init_distributed,wrap_model,unwrap_model,is_main_process,all_reduce_sum,get_world_size,get_rank,gather_list
+from timing import StepTimer,count_tokens,add_scalars
+from utils import save_checkpoint,clip_gradient,AsyncCheckpointer,get_rng_state,set_rng_state,resume_training
 
 
 
-def train_epoch(model, train_iter, epoch,loss_fn,optimizer,log_dict):
+def train_epoch(model, train_iter, epoch,loss_fn,optimizer,log_dict,lr_scheduler=None,start=None,save_last=None,timer=None):
 
-	total_epoch_loss = 0
-	total_epoch_acc = 0
-	model.cuda()
-	steps = 0
+	## start is the position inside the epoch a resumed run continues from, save_last(epoch,position) stores it
+	start = start or {"batch":0,"total_epoch_loss":0,"total_epoch_acc":0}
+	total_epoch_loss = start["total_epoch_loss"]
+	total_epoch_acc = start["total_epoch_acc"]
+	device = get_device(log_dict.param)
+	model.to(device)
 	model.train()
-	start_train_time = time.time()
-
-
-	for idx, batch in enumerate(train_iter):
+	## one optimizer step every accumulation_steps batches, the last window of the epoch may be shorter
+	accumulation_steps = log_dict.param.get("accumulation_steps",1)
+	steps = start["batch"]//accumulation_steps ## counted from the epoch start, a resumed run saves and reports at the same steps
+	n_batches = len(train_iter)
+	checkpoint_every = log_dict.param.get("checkpoint_every")
+	if start["batch"]: ## the batches trained before the checkpoint are skipped
+		train_iter.batch_sampler.set_start(start["batch"])
+	batches = iter(train_iter)
+	if "rng" in start: ## restored after the loader drew its seed from the torch generator, as in the interrupted run
+		set_rng_state(start["rng"])
+	timer = timer or StepTimer(device) ## time of every phase of the steps, see train_model for the summary
+	timer.start()
+
+
+	for idx, batch in enumerate(batches,start["batch"]):
 
 		text, attn, target = select_input(batch,log_dict.param)
-
-		if (len(target)is not log_dict.param.batch_size):# Last batch may have length different than log_dict.param.batch_size
-			continue
-
-		if torch.cuda.is_available():
-			text = [text[0].cuda(),text[1].cuda(),text[2].cuda(),text[3].cuda()]
-
-			attn = attn.cuda()
-			target = target.cuda()
-
-		## model prediction
-		model.zero_grad()
-		optimizer.zero_grad()
-		# print("Prediction")
-		prediction = model(text,attn)
-		# print("computing loss")
-		loss = loss_fn(prediction, target)
-
-		# print("Loss backward")
-		startloss = time.time()
-		loss.backward()
-		# print(time.time()-startloss,"Finish loss")
-		clip_gradient(model, 1e-1)
-		# torch.nn.utils.clip_grad_norm_(model.parameters(),1)
-		optimizer.step()
-		# print("=====================")
-		steps += 1
-		if steps % 100 == 0:
-			print (f'Epoch: {epoch+1:02}, Idx: {idx+1}, Training Loss: {loss.item():.4f}, Time taken: {((time.time()-start_train_time)/60): .2f} min')
-			start_train_time = time.time()
+		timer.count(target.size(0),count_tokens(batch))
+		timer.lap("data")
+
+		text = [t.to(device) for t in text]
+		attn = attn.to(device)
+		target = target.to(device)
+		timer.lap("transfer")
+
+		if idx % accumulation_steps == 0:
+			model.zero_grad()
+			optimizer.zero_grad()
+			window_size = min(accumulation_steps,n_batches-idx)
+			timer.lap("optimizer")
+		last_in_window = (idx+1) % accumulation_steps == 0 or idx == n_batches-1
+
+		## model prediction, gradients are only synchronised between processes on the last batch of the window
+		with (nullcontext() if last_in_window or not hasattr(model,"no_sync") else model.no_sync()):
+			# print("Prediction")
+			prediction = model(text,attn)
+			timer.lap("forward")
+			# print("computing loss")
+			loss = loss_fn(prediction, target)
+			timer.lap("loss")
+
+			# print("Loss backward")
+			(loss/window_size).backward() ## the accumulated gradient is the mean over the window
+			timer.lap("backward")
+
+		if last_in_window:
+			clip_gradient(model, 1e-1)
+			timer.lap("clip")
+			# torch.nn.utils.clip_grad_norm_(model.parameters(),1)
+			optimizer.step()
+			if lr_scheduler is not None:
+				lr_scheduler.step()
+			timer.lap("optimizer")
+			# print("=====================")
+			steps += 1
+			if steps % 100 == 0:
+				print (f'Epoch: {epoch+1:02}, Idx: {idx+1}, Training Loss: {loss.item():.4f}, {timer.report()}')
 
 		total_epoch_loss += loss.item()
 
+		## last.pth.tar, at the end of a window so that no accumulated gradient is lost
+		if save_last is not None and last_in_window and checkpoint_every and steps % checkpoint_every == 0 and idx < n_batches-1:
+			save_last(epoch,{"batch":idx+1,"total_epoch_loss":total_epoch_loss,"total_epoch_acc":total_epoch_acc,"rng":get_rng_state()})
+		timer.lap("other")
+
 		# break
 
 	return total_epoch_loss/len(train_iter)
 
-def train_model(log_dict,data,model,loss_fn,optimizer,lr_scheduler,writer,save_home):
+def train_model(log_dict,data,model,loss_fn,optimizer,lr_scheduler,writer,save_home,resume=None,should_stop=None):
 
 	best_f1_score = 0
 	patience_flag = 0
 	train_iter,valid_iter,test_iter = data[0],data[1],data[2] # data is a tuple of three iterators
+	start_epoch = log_dict.param.get("start_epoch",0)
+	start = None
+	if resume is not None: ## continues where last.pth.tar was saved, see resume_training for the model and optimizer
+		best_f1_score,patience_flag = resume["best"],resume["patience_flag"]
+		start_epoch,start = resume["epoch"],resume["start"][get_rank()]
+		if patience_flag == log_dict.param.patience: ## the run had stopped early
+			return
+
+	## checkpoints are written in the background by the first process
+	checkpointer = AsyncCheckpointer() if is_main_process() else None
+
+	def save_last(epoch,start):
+		## every process continues from its own position and random state
+		starts,rng_states = gather_list([start]),gather_list([get_rng_state()])
+		if checkpointer is None:
+			return
+		os.makedirs(save_home,exist_ok=True)
+		lr_state = lr_scheduler.state_dict() if lr_scheduler is not None else None
+		checkpointer.save({'epoch': epoch,'start':starts,'best':best_f1_score,'patience_flag':patience_flag,'log_dict':json.loads(json.dumps(log_dict)),'arch': log_dict.param.arch_name,'state_dict': unwrap_model(model).state_dict(),'param':dict(log_dict.param),'optimizer' : optimizer.state_dict(),'lr_scheduler':lr_state,'rng':rng_states},save_home+"/last.pth.tar")
+
+	## step time breakdown of every epoch, timing.json next to log.json
+	timings = []
+	if resume is not None and os.path.exists(save_home+"/timing.json"):
+		with open(save_home+"/timing.json") as fp:
+			timings = json.load(fp)
 
 	# print("Start Training")
-	for epoch in range(0,log_dict.param.nepoch):
+	for epoch in range(start_epoch,log_dict.param.nepoch):
 
-		## train and validation
+		for sampler in [train_iter.sampler,train_iter.batch_sampler]: ## a new order every epoch, bucketed or distributed
+			if hasattr(sampler,"set_epoch"):
+				sampler.set_epoch(epoch)
 
-		train_loss = train_epoch(model, train_iter, epoch,loss_fn,optimizer,log_dict)
+		## train and validation
 
-		val_loss, val_result = eval_model(model, valid_iter,loss_fn,log_dict,save_home)
+		timer = StepTimer(get_device(log_dict.param))
+		train_loss = train_epoch(model, train_iter, epoch,loss_fn,optimizer,log_dict,lr_scheduler,start,save_last,timer)
+		start = None
+		## averaged over the processes in distributed training, validation and test metrics are gathered by eval_model
+		train_loss = all_reduce_sum(train_loss)/get_world_size()
+		## the phases of the first process, the throughput of all of them
+		timing = timer.summary()
+		timing["samples_per_sec"],timing["tokens_per_sec"] = all_reduce_sum(timing["samples_per_sec"]),all_reduce_sum(timing["tokens_per_sec"])
+
+		## per-class thresholds tuned on validation (see config_multilabel.py), the test split is evaluated with them. The
+		## best model and early stopping go by the validation F1 at the fixed threshold, the tuned one is reported apart
+		## the logits of every epoch and split are kept, eval_logits.py recomputes metrics from them
+		logits_home = save_home+"/logits/"
+		val_loss, val_result = eval_model(model, valid_iter,loss_fn,log_dict,save_home,tune_thresholds=log_dict.param.get("tune_thresholds",False),logits_file=f"{logits_home}valid_epoch{epoch+1:02}.npz")
 
-		print(f'Epoch: {epoch+1:02}, Train Loss: {train_loss:.3f}, Val. Loss: {val_loss:3f}, Val. F1: {val_result["f1"]:.2f}')
 		## testing
-		test_loss, test_result = eval_model(model, test_iter,loss_fn,log_dict,save_home)
+		test_loss, test_result = eval_model(model, test_iter,loss_fn,log_dict,save_home,thresholds=val_result["thresholds"],logits_file=f"{logits_home}test_epoch{epoch+1:02}.npz")
 
-		print(f'Test Loss: {test_loss:.3f}, Test F1 score: {test_result["f1"]:.4f}')
+		if is_main_process():
+			tuned_f1 = f', Val. tuned F1: {val_result["tuned_f1"]:.2f}' if "tuned_f1" in val_result else ""
+			print(f'Epoch: {epoch+1:02}, Train Loss: {train_loss:.3f}, Val. Loss: {val_loss:3f}, Val. F1: {val_result["f1"]:.2f}{tuned_f1}')
+			print(f'Test Loss: {test_loss:.3f}, Test F1 score: {test_result["f1"]:.4f}')
 
-		## save best model
+		## save best model, only the first process writes checkpoints and logs
 		is_best = val_result["f1"] > best_f1_score
 
-		save_checkpoint({'epoch': epoch + 1,'arch': log_dict.param.arch_name,'state_dict': model.state_dict(),'train_loss':train_loss,"val_result":val_result,'param':dict(log_dict.param),'optimizer' : optimizer.state_dict()},is_best,save_home+"/model_best.pth.tar")
+		if is_main_process():
+			save_checkpoint({'epoch': epoch + 1,'arch': log_dict.param.arch_name,'state_dict': unwrap_model(model).state_dict(),'train_loss':train_loss,"val_result":val_result,'param':dict(log_dict.param),'thresholds':val_result["thresholds"],'optimizer' : optimizer.state_dict()},is_best,save_home+"/model_best.pth.tar",checkpointer)
 
 		best_f1_score = max(val_result["f1"], best_f1_score)
-		if log_dict.param.step_size != None:
-			lr_scheduler.step()
+
+		## tensorboard runs and timing.json
+		if writer is not None:
+			add_scalars(writer,timing,epoch)
+		timings.append(dict(epoch=epoch+1,**timing))
+		if is_main_process():
+			os.makedirs(save_home,exist_ok=True)
+			with open(save_home+"/timing.json", 'w') as fp:
+				json.dump(timings, fp,indent=4)
+			fp.close()
 
 		## save logs
 		if is_best:
@@ -123,26 +207,46 @@ def train_model(log_dict,data,model,loss_fn,optimizer,lr_scheduler,writer,save_h
 
 			log_dict["epoch"] = epoch+1
 
-			with open(save_home+"/log.json", 'w') as fp:
-				json.dump(dict(log_dict), fp,indent=4)
-			fp.close()
+			if is_main_process():
+				with open(save_home+"/log.json", 'w') as fp:
+					json.dump(dict(log_dict), fp,indent=4)
+				fp.close()
 		else:
 			patience_flag += 1
 
-		## early stopping
-		if patience_flag == log_dict.param.patience or epoch == log_dict.param.nepoch-1:
-			print(log_dict)
+		save_last(epoch+1,None)
+
+		## early stopping, should_stop(epoch,validation metric) lets a sweep end poor trials (see sweep.py)
+		stopped = should_stop is not None and should_stop(epoch,val_result["f1"])
+		if patience_flag == log_dict.param.patience or epoch == log_dict.param.nepoch-1 or stopped:
+			if is_main_process():
+				print(log_dict)
 			break
 
+	if checkpointer is not None:
+		checkpointer.close()
+
 
 if __name__ == '__main__':
 
 
+	parser = argparse.ArgumentParser(description='Train on goemotions/semeval with the parameters of config_multilabel.py')
+	parser.add_argument('-r','--resume', default=None,type=str,
+	               help='Enter the path of a last.pth.tar to continue its run, with its own parameters and save directory')
+	args = parser.parse_args()
+
 	log_dict = edict({})
 	log_dict.param = train_config.param
+	resume = None
+	if args.resume is not None:
+		resume = torch.load(args.resume,map_location="cpu")
+		log_dict = edict(resume["log_dict"])
+	init_distributed(log_dict.param) ## started by torchrun, see README
+	if resume is not None and len(resume["rng"]) != get_world_size():
+		raise SystemExit(f'{args.resume} was saved by {len(resume["rng"])} processes, resume with as many')
 
 
-	if train_config.tuning:
+	if train_config.tuning and resume is None:
 
 	## Initialising parameters from train_config
 
@@ -162,7 +266,7 @@ if __name__ == '__main__':
 				## Loading data
 				print('Loading dataset')
 				start_time = time.time()
-				train_iter, valid_iter ,test_iter= dataset.get_dataloader(log_dict.param.batch_size,log_dict.param.dataset,log_dict.param.arch_name)
+				train_iter, valid_iter ,test_iter= dataset.get_dataloader(log_dict.param.batch_size,log_dict.param.dataset,log_dict.param.arch_name,log_dict.param.data_format,log_dict.param.max_tokens,log_dict.param.eval_batch_size,log_dict.param.max_len,log_dict.param.truncation,log_dict.param.packing)
 
 				data = (train_iter,valid_iter,test_iter)
 				finish_time = time.time()
@@ -170,17 +274,22 @@ if __name__ == '__main__':
 
 				## Initialising model, loss, optimizer, lr_scheduler
 				model = select_model(log_dict.param)
+				if log_dict.param.freeze: ## train the head on cached encoder outputs
+					data = encoder_cache.get_cached_dataloader(model,data,log_dict.param)
+				model = wrap_model(model) ## DistributedDataParallel when started by torchrun
 
 				loss_fn = nn.BCEWithLogitsLoss()
 
 				optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()),lr=log_dict.param.learning_rate)
-				if log_dict.param.step_size != None:
-					lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer,log_dict.param.step_size, gamma=0.5)
+				lr_scheduler = None
+				if log_dict.param.step_size != None: ## step_size is in epochs, the scheduler is stepped after every optimizer step
+					steps_per_epoch = math.ceil(len(data[0])/log_dict.param.accumulation_steps)
+					lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer,log_dict.param.step_size*steps_per_epoch, gamma=0.5)
 
 
 				## Filepaths for saving the model and the tensorboard runs
 				model_run_time = time.strftime("%Y_%m_%d_%H_%M_%S", time.localtime())
-				writer = SummaryWriter("./runs/"+arch_name+"/")
+				writer = SummaryWriter("./runs/"+arch_name+"/") if is_main_process() else None
 				save_home = "./save/"+log_dict.param.dataset+"/"+log_dict.param.arch_name+"/"+model_run_time
 
 				# print(train_config)
@@ -196,7 +305,7 @@ if __name__ == '__main__':
 		## Loading data
 		print('Loading dataset')
 		start_time = time.time()
-		train_iter, valid_iter ,test_iter= dataset.get_dataloader(log_dict.param.batch_size,log_dict.param.dataset,log_dict.param.arch_name)
+		train_iter, valid_iter ,test_iter= dataset.get_dataloader(log_dict.param.batch_size,log_dict.param.dataset,log_dict.param.arch_name,log_dict.param.data_format,log_dict.param.max_tokens,log_dict.param.eval_batch_size,log_dict.param.max_len,log_dict.param.truncation,log_dict.param.packing)
 
 		data = (train_iter,valid_iter,test_iter)
 		finish_time = time.time()
@@ -204,17 +313,25 @@ if __name__ == '__main__':
 
 		## Initialising model, loss, optimizer, lr_scheduler
 		model = select_model(log_dict.param)
+		if log_dict.param.freeze: ## train the head on cached encoder outputs
+			data = encoder_cache.get_cached_dataloader(model,data,log_dict.param)
+		model = wrap_model(model) ## DistributedDataParallel when started by torchrun
 
 		loss_fn = nn.BCEWithLogitsLoss()
 
 		optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()),lr=log_dict.param.learning_rate)
 
-		if log_dict.param.step_size != None:
-			lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer,log_dict.param.step_size, gamma=0.5)
+		lr_scheduler = None
+		if log_dict.param.step_size != None: ## step_size is in epochs, the scheduler is stepped after every optimizer step
+			steps_per_epoch = math.ceil(len(data[0])/log_dict.param.accumulation_steps)
+			lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer,log_dict.param.step_size*steps_per_epoch, gamma=0.5)
 
 		## Filepaths for saving the model and the tensorboard runs
 		model_run_time = time.strftime("%Y_%m_%d_%H_%M_%S", time.localtime())
-		writer = SummaryWriter("./runs/"+log_dict.param.arch_name+"/")
+		writer = SummaryWriter("./runs/"+log_dict.param.arch_name+"/") if is_main_process() else None
 		save_home = "./save/"+log_dict.param.dataset+"/"+log_dict.param.arch_name+"/"+model_run_time
+		if resume is not None: ## model, optimizer, scheduler and random state as they were saved
+			resume_training(resume,unwrap_model(model),optimizer,lr_scheduler,get_rank())
+			save_home = os.path.dirname(args.resume)
 
-		train_model(log_dict,data,model,loss_fn,optimizer,lr_scheduler,writer,save_home)
+		train_model(log_dict,data,model,loss_fn,optimizer,lr_scheduler,writer,save_home,resume)
@@ -1,10 +1,44 @@
+import os
 import re
+import random
+import queue
+import atexit
+import threading
+import numpy as np
 import torch
 
 def flatten_list(l):
     flattened_list=[item for sublist in l for item in sublist]
     return flattened_list
 
+def chunk_list(l,chunk_size):
+    chunked_list = [l[i:i+chunk_size] for i in range(0,len(l),chunk_size)]
+    return chunked_list
+
+def truncate_sequence(seq,max_len,truncation="head"):
+    '''
+    Keeps at most max_len items of a token or lexicon sequence (list, numpy array or tensor). "head" keeps the start,
+    "tail" the first ([CLS]) token and the end, "head_tail" the first quarter and the end
+    '''
+    if max_len is None or len(seq) <= max_len:
+        return seq
+
+    if truncation == "head":
+        return seq[:max_len]
+    elif truncation == "tail":
+        head = 1
+    elif truncation == "head_tail":
+        head = max_len//4
+    else:
+        raise ValueError("truncation should be head, tail or head_tail, got "+str(truncation))
+
+    parts = [seq[:head],seq[len(seq)-(max_len-head):]]
+    if torch.is_tensor(seq):
+        return torch.cat(parts)
+    if isinstance(seq,np.ndarray):
+        return np.concatenate(parts)
+    return list(parts[0])+list(parts[1])
+
 def tweet_preprocess(tweet):
     x_proc_i= [''.join([i if ord(i) < 128 else '' for i in text]) for text in x_i]
     x_proc_i = "".join(x_proc_i).replace(r'(RT|rt)[ ]*@[ ]*[\S]+',r'')
@@ -35,11 +69,105 @@ def tweet_preprocess(tweet):
 
     return x_proc_i
 
-def save_checkpoint(state, is_best,filename):
+def atomic_save(state,filename):
+    ## written next to the target and renamed, a crash never leaves a truncated checkpoint behind
+    torch.save(state,filename+".tmp")
+    os.replace(filename+".tmp",filename)
+
+def to_cpu(state):
+    '''
+    Copies every tensor of a (nested) state dict to new cpu memory, a snapshot that training can keep updating in place
+    '''
+    if torch.is_tensor(state):
+        return state.detach().to("cpu",copy=True)
+    if isinstance(state,dict):
+        return type(state)((k,to_cpu(v)) for k,v in state.items())
+    if isinstance(state,(list,tuple)):
+        return type(state)(to_cpu(v) for v in state)
+    return state
+
+
+class AsyncCheckpointer:
+
+    '''
+    Writes checkpoints from a background thread. save() only takes a cpu snapshot of the state on the training thread,
+    at most one write is pending, and errors of a write are raised by the next save() or close()
+    '''
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+        atexit.register(self.close) ## pending writes finish before the interpreter exits
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                atomic_save(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self,state,filename):
+        self.check_error()
+        self.queue.put((to_cpu(state),filename))
+
+    def wait(self):
+        self.queue.join()
+        self.check_error()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.check_error()
+
+
+def save_checkpoint(state, is_best,filename,checkpointer=None):
     if is_best:
-        torch.save(state,filename)
+        if checkpointer is not None:
+            checkpointer.save(state,filename)
+        else:
+            atomic_save(state,filename)
 
 def clip_gradient(model, clip_value):
     params = list(filter(lambda p: p.grad is not None, model.parameters()))
     for p in params:
         p.grad.data.clamp_(-clip_value, clip_value)
+
+def get_rng_state():
+    ## only tensors and python builtins, the state loads with torch.load(weights_only=True) as well
+    name,keys,pos,has_gauss,cached_gaussian = np.random.get_state()
+    state = {"python":random.getstate(),"numpy":(name,torch.from_numpy(keys.astype(np.int64)),pos,has_gauss,cached_gaussian),"torch":torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    name,keys,pos,has_gauss,cached_gaussian = state["numpy"]
+    np.random.set_state((name,keys.numpy().astype(np.uint32),pos,has_gauss,cached_gaussian))
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+def resume_training(checkpoint,model,optimizer,lr_scheduler=None,rank=0):
+    '''
+    Restores model, optimizer, scheduler and the random number generators of process rank from a last.pth.tar, after
+    they are created
+    '''
+    model.load_state_dict(checkpoint["state_dict"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    if lr_scheduler is not None and checkpoint["lr_scheduler"] is not None:
+        lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
+    set_rng_state(checkpoint["rng"][rank])